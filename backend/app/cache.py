@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Generic, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    Thread-safe cache keeping the `max_size` most recently used entries, each for at
+    most `ttl_seconds` (if given)
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float | None = None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[K, tuple[V, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: K, value: V, ttl_seconds: float | None = None) -> None:
+        """
+        Store `value`, for `ttl_seconds` if given and shorter than the cache's TTL
+        """
+        ttls = [ttl for ttl in (self.ttl_seconds, ttl_seconds) if ttl is not None]
+        expires_at = time.monotonic() + min(ttls) if ttls else float("inf")
+
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: K) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_where(self, predicate: Callable[[V], bool]) -> None:
+        with self._lock:
+            for key in [
+                key for key, (value, _) in self._entries.items() if predicate(value)
+            ]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+from collections.abc import Sequence
+
+import httpx
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import Session, select
+
+from app import parse_pool, utils
+from app.config import settings
+from app.crud import recalculate_cleaning_dates, update_calendar_content
+from app.database import engine
+from app.http_client import get_shared_http_client
+from app.models.calendars import Calendar
+
+
+logger = logging.getLogger(__name__)
+
+
+async def fetch_if_changed(
+    http_client: httpx.AsyncClient, calendar: Calendar
+) -> utils.FetchedCalendar | None:
+    headers = utils.conditional_request_headers(calendar)
+
+    try:
+        return await utils.fetch_calendar(http_client, calendar.url or "", headers)
+    except HTTPException as e:
+        logger.warning("Syncing calendar %s failed: %s", calendar.id, e.detail)
+        return None
+
+
+def apply_fetched_calendar(
+    session: Session, calendar: Calendar, fetched: utils.FetchedCalendar
+) -> bool:
+    """
+    Save fetched file to the calendar, returns whether its events changed
+    """
+    # 304 responses don't have to repeat the validators
+    calendar.etag = fetched.etag or calendar.etag
+    calendar.last_modified = fetched.last_modified or calendar.last_modified
+    session.add(calendar)
+
+    if (
+        fetched.content is None
+        or utils.content_hash(fetched.content) == calendar.content_hash
+    ):
+        session.commit()
+        return False
+
+    try:
+        parsed_calendar = parse_pool.read_calendar(fetched.content)
+    except HTTPException as e:
+        session.commit()
+        logger.warning("Calendar %s is no longer valid: %s", calendar.id, e.detail)
+        return False
+
+    update_calendar_content(session, calendar, fetched.content, parsed_calendar.events)
+    session.commit()
+
+    return True
+
+
+async def sync_calendars(session: Session, http_client: httpx.AsyncClient) -> set[str]:
+    """
+    Refresh all calendars imported from URL and recalculate cleaning dates of users
+    whose calendars changed. Returns usernames of those users.
+    """
+    # Queries, parsing and recalculation block, so only fetching runs on the event loop
+    calendars = await run_in_threadpool(
+        lambda: session.exec(select(Calendar).where(Calendar.url != None)).all()
+    )
+
+    semaphore = asyncio.Semaphore(settings.CALENDAR_SYNC_CONCURRENCY)
+
+    async def fetch(calendar: Calendar) -> utils.FetchedCalendar | None:
+        async with semaphore:
+            return await fetch_if_changed(http_client, calendar)
+
+    fetched_calendars = await asyncio.gather(
+        *(fetch(calendar) for calendar in calendars)
+    )
+
+    return await run_in_threadpool(
+        save_fetched_calendars, session, calendars, fetched_calendars
+    )
+
+
+def save_fetched_calendars(
+    session: Session,
+    calendars: Sequence[Calendar],
+    fetched_calendars: Sequence[utils.FetchedCalendar | None],
+) -> set[str]:
+    changed_users = {}
+    for calendar, fetched in zip(calendars, fetched_calendars):
+        if fetched is not None and apply_fetched_calendar(session, calendar, fetched):
+            changed_users[calendar.user.username] = calendar.user
+
+    for user in changed_users.values():
+        recalculate_cleaning_dates(session, user)
+    session.commit()
+
+    return set(changed_users)
+
+
+async def run_calendar_sync(interval_seconds: int):
+    """
+    Sync calendars every `interval_seconds`, until cancelled
+    """
+    while True:
+        await asyncio.sleep(interval_seconds)
+
+        try:
+            with Session(engine) as session:
+                changed_users = await sync_calendars(session, get_shared_http_client())
+            logger.info("Synced calendars, %d users changed", len(changed_users))
+        except Exception:
+            logger.exception("Syncing calendars failed")
@@ -2,10 +2,27 @@ from collections.abc import Sequence
 from datetime import date
 from dataclasses import dataclass
 
+import numpy as np
+
+from app.cache import LRUCache
+from app.config import settings
 from app.models.calendars import Calendar, CleaningDate
 
 
-@dataclass
+_UNIX_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Events are always saved together with the hash of the file they came from, so buffers
+# of a calendar and the schedule of a set of calendars can be cached by those hashes
+buffer_cache: LRUCache[tuple[int, str], list["CleaningBuffer"]] = LRUCache(
+    max_size=settings.CLEANING_BUFFER_CACHE_SIZE
+)
+schedule_cache: LRUCache[tuple, list[tuple[int, date]]] = LRUCache(
+    max_size=settings.CLEANING_SCHEDULE_CACHE_SIZE
+)
+
+
+# Slotted and frozen to keep memory low, batch runs create one for every booking
+@dataclass(frozen=True, slots=True)
 class Event:
     date_start: date
     date_end: date
@@ -14,88 +31,323 @@ class Event:
         return self.date_start < other.date_start
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class CleaningBuffer:
     calendar_id: int
     start: date
     end: date
-    cleaned: bool = False
-
-    def __lt__(self, other):
-        """
-        For cleaning buffer we want to now which one "expires" first (has the oldest end date)
-        """
-        return self.end < other.end
-
-    def can_be_cleaned_with_other(self, other):
-        return not (self.start > other.end or self.end < other.start)
 
 
 def create_cleaning_buffers(calendars: Sequence[Calendar]) -> list[CleaningBuffer]:
     cleaning_buffers: list[CleaningBuffer] = []
 
     for calendar in calendars:
-        events = [
-            Event(
-                date_start=event.date_start,
-                date_end=event.date_end,
-            )
-            for event in calendar.events
-        ]
-        # Sort events by starting dates
-        events.sort()
-
-        # We know that:
-        #   1. events are sorted by starting dates
-        #   2. events don't have overlap (because we don't allow them when creating calendars)
-        # Cleaning buffer can then be found by looking at the difference between end of current
-        # event and start of the next event
-        for event, next_event in zip(events, events[1:]):
-            if not calendar.id:
-                continue
-
-            cleaning_buffers.append(
-                CleaningBuffer(
-                    calendar_id=calendar.id,
-                    start=event.date_end,
-                    end=next_event.date_start,
-                )
+        cache_key = _buffer_cache_key(calendar)
+        calendar_buffers = buffer_cache.get(cache_key) if cache_key else None
+
+        if calendar_buffers is None:
+            calendar_buffers = _create_calendar_cleaning_buffers(calendar)
+            if cache_key:
+                buffer_cache.set(cache_key, calendar_buffers)
+
+        cleaning_buffers.extend(calendar_buffers)
+
+    return cleaning_buffers
+
+
+def has_cached_buffers(calendar: Calendar) -> bool:
+    """
+    Whether `create_cleaning_buffers` can skip the calendar's events
+    """
+    cache_key = _buffer_cache_key(calendar)
+    return cache_key is not None and buffer_cache.get(cache_key) is not None
+
+
+def _buffer_cache_key(calendar: Calendar) -> tuple[int, str] | None:
+    content_hash = getattr(calendar, "content_hash", None)
+    if not calendar.id or not content_hash:
+        return None
+
+    return calendar.id, content_hash
+
+
+def _create_calendar_cleaning_buffers(calendar: Calendar) -> list[CleaningBuffer]:
+    cleaning_buffers: list[CleaningBuffer] = []
+
+    events = [
+        Event(date_start=event.date_start, date_end=event.date_end)
+        for event in calendar.events
+    ]
+    # Sort events by starting dates
+    events.sort()
+
+    # We know that:
+    #   1. events are sorted by starting dates
+    #   2. events don't have overlap (we don't allow them when creating calendars)
+    # Cleaning buffer can then be found by looking at the difference between end of
+    # current event and start of the next event
+    for event, next_event in zip(events, events[1:]):
+        if not calendar.id:
+            continue
+
+        cleaning_buffers.append(
+            CleaningBuffer(
+                calendar_id=calendar.id,
+                start=event.date_end,
+                end=next_event.date_start,
             )
+        )
 
     return cleaning_buffers
 
 
-def calculate_cleaning_times(calendars: Sequence[Calendar]) -> list[CleaningDate]:
+def find_cleaning_dates(
+    cleaning_buffers: Sequence[CleaningBuffer],
+) -> list[tuple[CleaningBuffer, date]]:
+    """
+    Greedy stabbing of cleaning buffers in O(n log n).
+
+    Picking the buffer that expires first and cleaning everything that overlaps it is
+    the same as sweeping the buffers sorted by start date: a buffer joins the current
+    cleaning day as long as it starts before the earliest end seen in that day,
+    otherwise it opens a new one. Result is ordered the same way as the original greedy
+    loop produced it (by cleaning day, then by position in `cleaning_buffers`).
+    """
+    by_start = sorted(
+        range(len(cleaning_buffers)), key=lambda i: cleaning_buffers[i].start
+    )
+
+    cleaning_days: list[date] = []
+    day_of_buffer = [0] * len(cleaning_buffers)
+
+    for i in by_start:
+        buffer = cleaning_buffers[i]
+        if not cleaning_days or buffer.start > cleaning_days[-1]:
+            cleaning_days.append(buffer.end)
+        elif buffer.end < cleaning_days[-1]:
+            # Buffers already in this day start before this one, so they can still be
+            # cleaned on its (earlier) end date
+            cleaning_days[-1] = buffer.end
+        day_of_buffer[i] = len(cleaning_days) - 1
+
+    # Stable sort keeps the original buffer order inside the same cleaning day
+    in_cleaning_order = sorted(
+        range(len(cleaning_buffers)), key=day_of_buffer.__getitem__
+    )
+
+    return [
+        (cleaning_buffers[i], cleaning_days[day_of_buffer[i]])
+        for i in in_cleaning_order
+    ]
+
+
+def create_cleaning_buffer_columns(
+    calendars: Sequence[Calendar],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Same buffers as `create_cleaning_buffers`, but as (calendar_id, start, end) arrays.
+
+    Dates are collected as ordinals first because NumPy converts Python dates to
+    datetime64 one by one, which is slower than building the buffer objects.
+    """
+    calendar_positions: list[int] = []
+    calendar_ids: list[int] = []
+    event_starts: list[int] = []
+    event_ends: list[int] = []
+
+    for position, calendar in enumerate(calendars):
+        if not calendar.id:
+            continue
+
+        for event in calendar.events:
+            calendar_positions.append(position)
+            calendar_ids.append(calendar.id)
+            event_starts.append(event.date_start.toordinal())
+            event_ends.append(event.date_end.toordinal())
+
+    positions = np.array(calendar_positions, dtype=np.int64)
+    starts = _ordinals_to_datetime64(event_starts)
+    ends = _ordinals_to_datetime64(event_ends)
+
+    # Sort events by start inside every calendar, keeping calendars in given order
+    order = np.lexsort((starts, positions))
+    positions, starts, ends = positions[order], starts[order], ends[order]
+
+    # Buffer is the difference between end of current event and start of the next event
+    # in the same calendar
+    same_calendar = positions[:-1] == positions[1:]
+
+    return (
+        np.array(calendar_ids, dtype=np.int64)[order][:-1][same_calendar],
+        ends[:-1][same_calendar],
+        starts[1:][same_calendar],
+    )
+
+
+def _ordinals_to_datetime64(ordinals: list[int]) -> np.ndarray:
+    return (np.array(ordinals, dtype=np.int64) - _UNIX_EPOCH_ORDINAL).astype(
+        "datetime64[D]"
+    )
+
+
+def find_cleaning_dates_vectorized(
+    starts: np.ndarray, ends: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Same as `find_cleaning_dates`, but on buffer columns.
+
+    Returns the order in which buffers are cleaned and the cleaning date of every
+    buffer. Every cleaning day is the earliest end among buffers starting after the
+    previous day, so only the (short) list of days is built in Python and buffers are
+    then matched to the first day that is not before their start.
+    """
+    by_start = np.argsort(starts, kind="stable")
+    sorted_starts = starts[by_start]
+    earliest_end_from = np.minimum.accumulate(ends[by_start][::-1])[::-1]
+
+    cleaning_days = []
+    i = 0
+    while i < len(sorted_starts):
+        cleaning_day = earliest_end_from[i]
+        cleaning_days.append(cleaning_day)
+        i = np.searchsorted(sorted_starts, cleaning_day, side="right")
+
+    days = np.array(cleaning_days, dtype="datetime64[D]")
+    day_of_buffer = np.searchsorted(days, starts, side="left")
+
+    return np.argsort(day_of_buffer, kind="stable"), days[day_of_buffer]
+
+
+def find_affected_window(
+    calendars: Sequence[Calendar], changed_calendars: Sequence[Calendar]
+) -> tuple[date, date] | None:
+    """
+    Date range which has to be recalculated after `changed_calendars` changed.
+
+    Buffers are chained together when one starts before the previous ones end, and
+    cleaning days are never shared between two separate chains. The range covering the
+    changed buffers is therefore widened to the edges of the chains it touches, and
+    everything outside of it keeps its cleaning days. `calendars` must contain the
+    changed calendars themselves.
+
+    Only valid for newly added calendars: the window is built from the current buffers,
+    so dates around events an update removed would stay stale outside of it. Updated
+    calendars need a full recalculation.
+    """
+    changed_buffers = create_cleaning_buffers(changed_calendars)
+    if not changed_buffers:
+        return None
+
+    window_start = min(buffer.start for buffer in changed_buffers)
+    window_end = max(buffer.end for buffer in changed_buffers)
+
+    chains: list[list[date]] = []
+    for buffer in sorted(create_cleaning_buffers(calendars), key=lambda b: b.start):
+        if chains and buffer.start <= chains[-1][1]:
+            chains[-1][1] = max(chains[-1][1], buffer.end)
+        else:
+            chains.append([buffer.start, buffer.end])
+
+    for chain_start, chain_end in chains:
+        if chain_start <= window_end and chain_end >= window_start:
+            window_start = min(window_start, chain_start)
+            window_end = max(window_end, chain_end)
+
+    return window_start, window_end
+
+
+def calculate_cleaning_times(
+    calendars: Sequence[Calendar],
+    window: tuple[date, date] | None = None,
+    vectorized: bool = False,
+) -> list[CleaningDate]:
     """
     Algorithm:
         - find all intervals which are free for cleaning (i.e. not occupied by guests) and save them to a list
         - pick first cleaning interval that "expires"
         - check which other apartments can be cleaned in that same interval
         - repeat until all cleaning intervals are cleaned
+
+    With `window` (see `find_affected_window`) only cleaning dates inside of it are
+    calculated. `vectorized` runs the same algorithm on NumPy arrays, which pays off for
+    many calendars.
     """
+    return [
+        CleaningDate(calendar_id=calendar_id, date=cleaning_date)
+        for calendar_id, cleaning_date in calculate_cleaning_dates(
+            calendars, window, vectorized
+        )
+    ]
 
-    cleaning_buffers = create_cleaning_buffers(calendars)
 
-    cleaning_times: list[CleaningDate] = []
+def calculate_cleaning_dates(
+    calendars: Sequence[Calendar],
+    window: tuple[date, date] | None = None,
+    vectorized: bool = False,
+) -> list[tuple[int, date]]:
+    """
+    Same as `calculate_cleaning_times`, but returns (calendar_id, date) pairs, which are
+    much cheaper to create than table models when the rows are inserted in bulk.
+
+    Results are memoized by the content hashes of `calendars` (and `window`).
+    """
+    cache_keys = [_buffer_cache_key(calendar) for calendar in calendars]
+    schedule_key = None if None in cache_keys else (tuple(cache_keys), window)
+
+    if schedule_key is not None:
+        cleaning_dates = schedule_cache.get(schedule_key)
+        if cleaning_dates is not None:
+            return list(cleaning_dates)
+
+    if vectorized:
+        cleaning_dates = _calculate_cleaning_dates_vectorized(calendars, window)
+    else:
+        cleaning_dates = _calculate_cleaning_dates(calendars, window)
+
+    if schedule_key is not None:
+        schedule_cache.set(schedule_key, list(cleaning_dates))
+
+    return cleaning_dates
 
-    while True:
-        not_cleaned_buffers = [
-            buffer for buffer in cleaning_buffers if not buffer.cleaned
+
+def _calculate_cleaning_dates(
+    calendars: Sequence[Calendar], window: tuple[date, date] | None
+) -> list[tuple[int, date]]:
+    cleaning_buffers = create_cleaning_buffers(calendars)
+
+    if window:
+        window_start, window_end = window
+        cleaning_buffers = [
+            buffer
+            for buffer in cleaning_buffers
+            if buffer.start >= window_start and buffer.end <= window_end
         ]
 
-        if not not_cleaned_buffers:
-            break
+    return [
+        (buffer.calendar_id, cleaning_date)
+        for buffer, cleaning_date in find_cleaning_dates(cleaning_buffers)
+    ]
+
+
+def _calculate_cleaning_dates_vectorized(
+    calendars: Sequence[Calendar], window: tuple[date, date] | None
+) -> list[tuple[int, date]]:
+    calendar_ids, starts, ends = create_cleaning_buffer_columns(calendars)
 
-        first_expiring = min(not_cleaned_buffers)
+    if window:
+        window_start, window_end = np.array(window, dtype="datetime64[D]")
+        in_window = (starts >= window_start) & (ends <= window_end)
+        calendar_ids, starts, ends = (
+            calendar_ids[in_window],
+            starts[in_window],
+            ends[in_window],
+        )
 
-        for buffer in not_cleaned_buffers:
-            if buffer.can_be_cleaned_with_other(first_expiring):
-                buffer.cleaned = True
-                cleaning_times.append(
-                    CleaningDate(
-                        calendar_id=buffer.calendar_id,
-                        date=first_expiring.end,
-                    )
-                )
+    cleaning_order, dates = find_cleaning_dates_vectorized(starts, ends)
 
-    return cleaning_times
+    return list(
+        zip(
+            calendar_ids[cleaning_order].tolist(),
+            dates[cleaning_order].tolist(),
+        )
+    )
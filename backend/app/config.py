@@ -9,6 +9,58 @@ class Settings(BaseSettings):
 
     SECRET_KEY: str = secrets.token_urlsafe(32)
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24
+    # Validated tokens, so authenticated requests don't have to look up the user
+    USER_CACHE_SIZE: int = 1024
+    USER_CACHE_TTL_SECONDS: int = 60
+
+    # Changing it rehashes passwords the next time their users log in
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASH_WORKERS: int = 2
+    # Logins and registrations waiting for a worker, beyond that they get 503
+    PASSWORD_HASH_QUEUE_SIZE: int = 32
+
+    DATABASE_URL: str = "sqlite:///database.db"
+    DATABASE_POOL_SIZE: int = 5
+    # Connections beyond the pool size, SQLite databases have no limit
+    DATABASE_MAX_OVERFLOW: int = 10
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+
+    CLEANING_BUFFER_CACHE_SIZE: int = 4096
+    CLEANING_SCHEDULE_CACHE_SIZE: int = 256
+    CLEANING_SCHEDULE_FEED_CACHE_SIZE: int = 256
+
+    # Biggest `limit` of GET /calendars/ pages, and calendars loaded at once when
+    # streaming them
+    CALENDARS_PAGE_MAX_SIZE: int = 500
+    CALENDARS_STREAM_BATCH_SIZE: int = 100
+
+    # Limit for each network operation (connecting, every read), a server sending the
+    # file slowly is stopped by the deadline for the whole download
+    CALENDAR_FETCH_TIMEOUT_SECONDS: float = 10
+    CALENDAR_FETCH_DEADLINE_SECONDS: float = 60
+    CALENDAR_FETCH_MAX_BYTES: int = 20 * 1024 * 1024
+    CALENDAR_FETCH_MAX_CONNECTIONS: int = 100
+
+    # 0 turns periodic syncing of calendars imported from URL off
+    CALENDAR_SYNC_INTERVAL_SECONDS: int = 60 * 30
+    CALENDAR_SYNC_CONCURRENCY: int = 10
+    # Files at least this big are parsed in a separate process, 0 workers disables it
+    CALENDAR_PARSE_WORKERS: int = 2
+    CALENDAR_PARSE_PROCESS_MIN_BYTES: int = 1024 * 1024
+    # Files and URLs in one batch import, and how many of its URLs are fetched at once
+    CALENDAR_BATCH_MAX_ITEMS: int = 100
+    CALENDAR_BATCH_FETCH_CONCURRENCY: int = 10
+
+    # "thread" recalculates cleaning dates in the background after imports, "inline"
+    # before responding
+    # Requests are merged and queued per process, workers don't share jobs
+    RECALCULATION_BACKEND: str = "thread"
+    # Imports for a user within this many seconds of each other share a recalculation
+    RECALCULATION_DELAY_SECONDS: float = 1
+    RECALCULATION_MAX_DELAY_SECONDS: float = 10
+    # Jobs kept for status requests
+    RECALCULATION_JOBS_KEPT: int = 10000
 
 
 settings = Settings()
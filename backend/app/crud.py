@@ -1,7 +1,17 @@
-from sqlmodel import Session
+import datetime
+from collections.abc import Sequence
 
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import exists
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, col, delete, insert, select, update
+
+from app import cleaning_algorithm, utils
+from app.models.calendars import Calendar, CalendarFile, CleaningDate, Event
 from app.models.users import User, UserCreate
-from app.security import get_password_hash, verify_password
+from app.security import verify_and_update_password
+from app.utils import ParsedEvent
 
 
 def get_user_by_username(session: Session, username: str) -> User | None:
@@ -9,20 +19,281 @@ def get_user_by_username(session: Session, username: str) -> User | None:
     return user
 
 
-def authenticate_user(session: Session, username: str, password: str) -> User | None:
-    user = get_user_by_username(session, username)
+async def authenticate_user(
+    session: Session, username: str, password: str
+) -> User | None:
+    user = await run_in_threadpool(get_user_by_username, session, username)
     if not user:
         return None
-    if not verify_password(password, user.hashed_password):
+
+    valid, new_hashed_password = await verify_and_update_password(
+        password, user.hashed_password
+    )
+    if not valid:
         return None
+
+    if new_hashed_password:
+        # Hashed with an older cost factor
+        user.hashed_password = new_hashed_password
+        session.add(user)
+        await run_in_threadpool(session.commit)
+        await run_in_threadpool(session.refresh, user)
+
     return user
 
 
-def create_user(session: Session, user_create: UserCreate) -> User:
+def create_user(
+    session: Session, user_create: UserCreate, hashed_password: str
+) -> User:
     user_in_db = User.model_validate(
-        user_create, update={"hashed_password": get_password_hash(user_create.password)}
+        user_create, update={"hashed_password": hashed_password}
     )
     session.add(user_in_db)
     session.commit()
     session.refresh(user_in_db)
     return user_in_db
+
+
+def add_calendar(
+    session: Session, calendar: Calendar, events: Sequence[ParsedEvent]
+) -> Calendar:
+    """
+    Add calendar with its events, inserted in bulk. Nothing is committed.
+    """
+    session.add(calendar)
+    session.flush()
+
+    insert_events(session, calendar, events)
+    return calendar
+
+
+def store_calendar_file(session: Session, content: bytes) -> str:
+    """
+    Save the file, unless some calendar already has it, and return its hash. Nothing is
+    committed.
+    """
+    content_hash = utils.content_hash(content)
+    values = {
+        "content_hash": content_hash,
+        "size": len(content),
+        "data": utils.compress_file(content),
+    }
+
+    if session.get_bind().dialect.name == "sqlite":
+        # Without checking first, so that a request storing the same file meanwhile (or
+        # deleting it as unused) can't make this one fail or point to a missing file
+        session.execute(
+            sqlite.insert(CalendarFile).values(values).on_conflict_do_nothing()
+        )
+    elif session.get(CalendarFile, content_hash) is None:
+        session.add(CalendarFile(**values))
+
+    return content_hash
+
+
+def delete_unused_calendar_file(session: Session, content_hash: str | None) -> None:
+    """
+    Delete the file if no calendar has it anymore, after a calendar's file changed or
+    the calendar was deleted. Nothing is committed.
+    """
+    if content_hash is None:
+        return
+
+    session.execute(
+        delete(CalendarFile).where(
+            col(CalendarFile.content_hash) == content_hash,
+            ~exists().where(col(Calendar.content_hash) == content_hash),
+        )
+    )
+
+
+def replace_calendar_events(
+    session: Session, calendar: Calendar, events: Sequence[ParsedEvent]
+) -> None:
+    session.execute(delete(Event).where(col(Event.calendar_id) == calendar.id))
+    insert_events(session, calendar, events)
+
+
+def update_calendar_content(
+    session: Session, calendar: Calendar, content: bytes, events: Sequence[ParsedEvent]
+) -> None:
+    """
+    Save new version of the calendar file, writing only the events that changed
+    (matched by UID). Nothing is committed.
+    """
+    old_content_hash = calendar.content_hash
+    calendar.content_hash = store_calendar_file(session, content)
+    calendar.updated_at = datetime.datetime.now(datetime.timezone.utc)
+    session.add(calendar)
+    if old_content_hash != calendar.content_hash:
+        delete_unused_calendar_file(session, old_content_hash)
+
+    existing_events = session.exec(
+        select(Event).where(Event.calendar_id == calendar.id)
+    ).all()
+    existing_by_uid = {event.uid: event for event in existing_events}
+    new_by_uid = {event.uid: event for event in events}
+
+    if len(existing_by_uid) < len(existing_events) or len(new_by_uid) < len(events):
+        # UIDs don't identify events (recurring events share them)
+        replace_calendar_events(session, calendar, events)
+        return
+
+    deleted_ids = [
+        event.id for uid, event in existing_by_uid.items() if uid not in new_by_uid
+    ]
+    inserted = [
+        event for uid, event in new_by_uid.items() if uid not in existing_by_uid
+    ]
+    updated = [
+        {
+            "id": existing_by_uid[uid].id,
+            "summary": event.summary,
+            "date_start": event.date_start,
+            "date_end": event.date_end,
+        }
+        for uid, event in new_by_uid.items()
+        if uid in existing_by_uid
+        and (
+            existing_by_uid[uid].summary,
+            existing_by_uid[uid].date_start,
+            existing_by_uid[uid].date_end,
+        )
+        != (event.summary, event.date_start, event.date_end)
+    ]
+
+    if deleted_ids:
+        session.execute(delete(Event).where(col(Event.id).in_(deleted_ids)))
+    if updated:
+        session.execute(update(Event), updated)
+    insert_events(session, calendar, inserted)
+
+
+def find_uploaded_calendar(
+    session: Session,
+    user: User,
+    name: str | None = None,
+    content_hash: str | None = None,
+) -> Calendar | None:
+    """
+    Calendar uploaded by the user (not imported from URL) with given PRODID or file hash
+    """
+    query = select(Calendar).where(
+        Calendar.user_id == user.username, Calendar.url == None  # noqa: E711
+    )
+    if name is not None:
+        query = query.where(Calendar.name == name)
+    if content_hash is not None:
+        query = query.where(Calendar.content_hash == content_hash)
+
+    return session.exec(query.order_by(col(Calendar.id))).first()
+
+
+def get_calendar_by_url(session: Session, user: User, url: str) -> Calendar | None:
+    return session.exec(
+        select(Calendar)
+        .where(Calendar.user_id == user.username, Calendar.url == url)
+        .order_by(col(Calendar.id))
+    ).first()
+
+
+def get_calendars_by_url(
+    session: Session, user: User, urls: Sequence[str]
+) -> dict[str, Calendar]:
+    """
+    `get_calendar_by_url` for many URLs at once, URLs without a calendar are left out
+    """
+    calendars: dict[str, Calendar] = {}
+    for calendar in session.exec(
+        select(Calendar)
+        .where(Calendar.user_id == user.username, col(Calendar.url).in_(urls))
+        .order_by(col(Calendar.id))
+    ):
+        if calendar.url is not None:
+            calendars.setdefault(calendar.url, calendar)
+    return calendars
+
+
+def insert_events(
+    session: Session, calendar: Calendar, events: Sequence[ParsedEvent]
+) -> None:
+    if events:
+        session.execute(
+            insert(Event),
+            [
+                {
+                    "calendar_id": calendar.id,
+                    "uid": event.uid,
+                    "summary": event.summary,
+                    "date_start": event.date_start,
+                    "date_end": event.date_end,
+                }
+                for event in events
+            ],
+        )
+
+    # Bulk inserts bypass the relationship, so load it again when it's needed
+    session.expire(calendar, ["events"])
+
+
+def recalculate_cleaning_dates(
+    session: Session, user: User, changed_calendars: Sequence[Calendar] | None = None
+) -> None:
+    """
+    Recalculate cleaning dates of all calendars belonging to the user. Nothing is
+    committed.
+
+    When `changed_calendars` are given, only cleaning dates in the date range they
+    affect are replaced and the rest of the stored schedule is left as it is. They must
+    be newly added calendars, see `cleaning_algorithm.find_affected_window`.
+    """
+    all_calendars = session.exec(select(Calendar).where(Calendar.user == user)).all()
+
+    # Events are only needed where the buffers aren't cached, those are loaded at once
+    uncached_calendar_ids = [
+        calendar.id
+        for calendar in all_calendars
+        if not cleaning_algorithm.has_cached_buffers(calendar)
+    ]
+    if uncached_calendar_ids:
+        session.exec(
+            select(Calendar).where(col(Calendar.id).in_(uncached_calendar_ids))
+            # SQLModel types relationships as lists, not as attributes
+            .options(selectinload(Calendar.events))  # type: ignore[arg-type]
+        ).all()
+
+    window = None
+    if changed_calendars is not None:
+        window = cleaning_algorithm.find_affected_window(
+            all_calendars, changed_calendars
+        )
+        if window is None:
+            return
+
+    user_calendar_ids = select(Calendar.id).where(Calendar.user_id == user.username)
+    delete_cleaning_dates = delete(CleaningDate).where(
+        col(CleaningDate.calendar_id).in_(user_calendar_ids)
+    )
+    if window:
+        window_start, window_end = window
+        delete_cleaning_dates = delete_cleaning_dates.where(
+            col(CleaningDate.date) >= window_start, col(CleaningDate.date) <= window_end
+        )
+    session.execute(delete_cleaning_dates)
+
+    cleaning_dates = cleaning_algorithm.calculate_cleaning_dates(all_calendars, window)
+    if cleaning_dates:
+        session.execute(
+            insert(CleaningDate),
+            [
+                {"calendar_id": calendar_id, "date": cleaning_date}
+                for calendar_id, cleaning_date in cleaning_dates
+            ],
+        )
+
+    # Cleaning schedule feeds are cached by it
+    session.execute(
+        update(Calendar)
+        .where(col(Calendar.user_id) == user.username)
+        .values(cleaning_dates_updated_at=datetime.datetime.now(datetime.timezone.utc))
+    )
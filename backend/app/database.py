@@ -1,15 +1,170 @@
+from sqlalchemy import Engine, event, inspect, make_url, text
 from sqlmodel import SQLModel, Session, create_engine
+from sqlmodel.pool import StaticPool
 
-sqlite_file_name = "database.db"
-sqlite_url = f"sqlite:///{sqlite_file_name}"
+from app import utils
+from app.config import settings
 
-engine = create_engine(sqlite_url)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    WAL lets readers work while another connection writes, and with synchronous=NORMAL
+    commits don't wait for fsync (which is still safe in WAL mode)
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+
+def create_db_engine(database_url: str) -> Engine:
+    url = make_url(database_url)
+
+    if url.get_backend_name() != "sqlite":
+        return create_engine(
+            url,
+            pool_size=settings.DATABASE_POOL_SIZE,
+            max_overflow=settings.DATABASE_MAX_OVERFLOW,
+            pool_pre_ping=True,
+        )
+
+    if url.database in (None, "", ":memory:"):
+        # In-memory database lives in a single connection, which every thread shares
+        return create_engine(
+            url, connect_args={"check_same_thread": False}, poolclass=StaticPool
+        )
+
+    engine = create_engine(
+        url,
+        connect_args={
+            "check_same_thread": False,
+            "timeout": settings.SQLITE_BUSY_TIMEOUT_MS / 1000,
+        },
+        pool_size=settings.DATABASE_POOL_SIZE,
+        # SQLite connections are just open files, so DATABASE_MAX_OVERFLOW doesn't
+        # apply. With a limit, threadpool threads waiting for a connection can block
+        # the requests holding them from finishing.
+        max_overflow=-1,
+    )
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+
+engine = create_db_engine(settings.DATABASE_URL)
+
+
+def add_missing_columns(bind: Engine):
+    """
+    `create_all` only creates missing tables, so columns added to models later are added
+    to existing tables here. All of them are nullable, so no defaults are needed.
+    """
+    inspector = inspect(bind)
+
+    with bind.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_columns = {
+                column["name"] for column in inspector.get_columns(table.name)
+            }
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                column_type = column.type.compile(bind.dialect)
+                connection.execute(
+                    text(
+                        f"ALTER TABLE {table.name} "
+                        f"ADD COLUMN {column.name} {column_type}"
+                    )
+                )
+
+
+def add_missing_indexes(bind: Engine):
+    """
+    Same as `add_missing_columns`, but for indexes
+    """
+    inspector = inspect(bind)
+
+    for table in SQLModel.metadata.sorted_tables:
+        if inspector.has_table(table.name):
+            for index in table.indexes:
+                index.create(bind, checkfirst=True)
+
+
+def move_calendar_content(bind: Engine):
+    """
+    Files used to be stored uncompressed in `calendar.content`, move them to the
+    `calendarfile` table. The old column is left empty.
+    """
+    inspector = inspect(bind)
+    if not inspector.has_table("calendar"):
+        return
+    if "content" not in {
+        column["name"] for column in inspector.get_columns("calendar")
+    }:
+        return
+
+    with bind.begin() as connection:
+        calendar_ids = (
+            connection.execute(
+                text("SELECT id FROM calendar WHERE content IS NOT NULL")
+            )
+            .scalars()
+            .all()
+        )
+
+        # One file at a time, they can be big
+        for calendar_id in calendar_ids:
+            content = connection.execute(
+                text("SELECT content FROM calendar WHERE id = :id"), {"id": calendar_id}
+            ).scalar_one()
+            content_hash = utils.content_hash(content)
+
+            stored = connection.execute(
+                text("SELECT 1 FROM calendarfile WHERE content_hash = :content_hash"),
+                {"content_hash": content_hash},
+            ).first()
+            if stored is None:
+                connection.execute(
+                    text(
+                        "INSERT INTO calendarfile (content_hash, size, data) "
+                        "VALUES (:content_hash, :size, :data)"
+                    ),
+                    {
+                        "content_hash": content_hash,
+                        "size": len(content),
+                        "data": utils.compress_file(content),
+                    },
+                )
+
+            connection.execute(
+                text(
+                    "UPDATE calendar SET content = NULL, content_hash = :content_hash "
+                    "WHERE id = :id"
+                ),
+                {"content_hash": content_hash, "id": calendar_id},
+            )
 
 
 def create_db_and_tables():
+    add_missing_columns(engine)
+    add_missing_indexes(engine)
     SQLModel.metadata.create_all(engine)
+    move_calendar_content(engine)
 
 
 def get_session():
     with Session(engine) as session:
         yield session
+
+
+def get_session_engine(session: Session) -> Engine:
+    """
+    Engine of the session, for opening other sessions to the same database
+    """
+    bind = session.get_bind()
+    return bind if isinstance(bind, Engine) else bind.engine
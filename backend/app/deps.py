@@ -1,24 +1,49 @@
-from typing import Annotated
+import time
+from typing import Annotated, Any
 
+import httpx
 import jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jwt.exceptions import InvalidTokenError
-from sqlmodel import Session
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from sqlmodel import Session, select
 
 from app import security
+from app.cache import LRUCache
 from app.config import settings
 from app.models.users import TokenData, User, User
 from app.database import get_session
+from app.http_client import get_http_client
 
 reusable_oauth2 = OAuth2PasswordBearer(tokenUrl="/token")
 
 
 SessionDep = Annotated[Session, Depends(get_session)]
 TokenDep = Annotated[str, Depends(reusable_oauth2)]
+HttpClientDep = Annotated[httpx.AsyncClient, Depends(get_http_client)]
 
+# Token -> columns of its user
+authenticated_users: LRUCache[str, dict[str, Any]] = LRUCache(
+    max_size=settings.USER_CACHE_SIZE, ttl_seconds=settings.USER_CACHE_TTL_SECONDS
+)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def forget_authenticated_user(mapper, connection, target: User):
+    authenticated_users.discard_where(lambda user: user["username"] == target.username)
+
+
+def get_current_user(session: SessionDep, token: TokenDep):
+    cached_user = authenticated_users.get(token)
+    if cached_user is not None:
+        # Attached to the session as if it was just loaded, without a query
+        detached_user = User(**cached_user)
+        make_transient_to_detached(detached_user)
+        return session.merge(detached_user, load=False)
 
-async def get_current_user(session: SessionDep, token: TokenDep):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -42,7 +67,29 @@ async def get_current_user(session: SessionDep, token: TokenDep):
     if user is None:
         raise credentials_exception
 
+    # Never longer than the token is valid
+    expires_in = payload["exp"] - time.time() if "exp" in payload else None
+    authenticated_users.set(token, user.model_dump(), ttl_seconds=expires_in)
+
     return user
 
 
 CurrentUser = Annotated[User, Depends(get_current_user)]
+
+
+def get_feed_user(session: SessionDep, feed_token: str) -> User:
+    """
+    Owner of the feed token in the URL, for calendar apps that can't send headers
+    """
+    user = session.exec(
+        select(User).where(User.feed_token_hash == security.hash_feed_token(feed_token))
+    ).first()
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="No feed with that token"
+        )
+
+    return user
+
+
+FeedUser = Annotated[User, Depends(get_feed_user)]
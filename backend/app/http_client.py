@@ -0,0 +1,39 @@
+import httpx
+
+from app.config import settings
+
+
+_http_client: httpx.AsyncClient | None = None
+
+
+def create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=settings.CALENDAR_FETCH_TIMEOUT_SECONDS,
+        limits=httpx.Limits(
+            max_connections=settings.CALENDAR_FETCH_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.CALENDAR_FETCH_MAX_CONNECTIONS,
+        ),
+        follow_redirects=True,
+    )
+
+
+def get_shared_http_client() -> httpx.AsyncClient:
+    """
+    Client shared between requests, so connections to calendar feeds are pooled
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = create_http_client()
+
+    return _http_client
+
+
+async def get_http_client():
+    yield get_shared_http_client()
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
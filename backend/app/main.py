@@ -1,8 +1,15 @@
+import asyncio
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 
+from app.calendar_sync import run_calendar_sync
+from app.config import settings
 from app.database import create_db_and_tables
+from app.http_client import close_http_client
+from app.parse_pool import close_parse_pool, start_parse_pool
+from app.recalculation import recalculation_queue
 from app.routes.main import api_router
 
 
@@ -12,8 +19,22 @@ app = FastAPI()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     create_db_and_tables()
+    start_parse_pool()
+
+    sync_task = None
+    if settings.CALENDAR_SYNC_INTERVAL_SECONDS:
+        sync_task = asyncio.create_task(
+            run_calendar_sync(settings.CALENDAR_SYNC_INTERVAL_SECONDS)
+        )
+
     yield
 
+    if sync_task:
+        sync_task.cancel()
+    await close_http_client()
+    close_parse_pool()
+    recalculation_queue.shutdown()
+
 
 app.router.lifespan_context = lifespan
 
@@ -28,6 +49,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Otherwise the frontend can't read them
+    expose_headers=["X-Recalculation-Job", "X-Next-Cursor"],
 )
 
 app.include_router(api_router)
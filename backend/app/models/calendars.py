@@ -1,6 +1,6 @@
 import datetime
 
-from sqlmodel import Field, Relationship, SQLModel
+from sqlmodel import Field, Index, Relationship, SQLModel
 
 from app.models.users import User
 
@@ -12,13 +12,36 @@ class CalendarBase(SQLModel):
 
 
 class Calendar(CalendarBase, table=True):
-    user_id: str | None = Field(default=None, foreign_key="user.username")
+    user_id: str | None = Field(default=None, foreign_key="user.username", index=True)
     user: User = Relationship(back_populates="calendars")
-    content: bytes | None
+    # File of the calendar is the `CalendarFile` with this hash
+    content_hash: str | None = Field(default=None)
+    # When the file last changed
+    updated_at: datetime.datetime | None = Field(
+        default_factory=lambda: datetime.datetime.now(datetime.timezone.utc)
+    )
+    # Validators from the last response of `url`, for conditional requests
+    etag: str | None = Field(default=None)
+    last_modified: str | None = Field(default=None)
+    # When cleaning dates of the user's calendars were last recalculated, cleaning
+    # schedule feeds are cached by it
+    cleaning_dates_updated_at: datetime.datetime | None = Field(default=None)
     events: list["Event"] = Relationship(back_populates="calendar")
     cleaning_dates: list["CleaningDate"] = Relationship(back_populates="calendar")
 
 
+class CalendarFile(SQLModel, table=True):
+    """
+    Gzip compressed calendar file, kept out of the calendar table so that loading
+    calendars doesn't load their files. Calendars with the same file share it.
+    """
+
+    content_hash: str = Field(primary_key=True)
+    # Size of the uncompressed file
+    size: int
+    data: bytes
+
+
 class CalendarUrlImport(SQLModel):
     url: str
 
@@ -28,6 +51,9 @@ class CleaningDateBase(SQLModel):
 
 
 class CleaningDate(CleaningDateBase, table=True):
+    # Cleaning dates of a calendar in a date range, or all of them by its leading column
+    __table_args__ = (Index("ix_cleaningdate_calendar_id_date", "calendar_id", "date"),)
+
     id: int | None = Field(default=None, primary_key=True)
     calendar_id: int | None = Field(default=None, foreign_key="calendar.id")
     calendar: Calendar = Relationship(back_populates="cleaning_dates")
@@ -46,6 +72,17 @@ class EventBase(SQLModel):
 
 
 class Event(EventBase, table=True):
+    # Events of a calendar overlapping a date range. Its leading column replaces an
+    # index on calendar_id alone.
+    __table_args__ = (
+        Index(
+            "ix_event_calendar_id_date_start_date_end",
+            "calendar_id",
+            "date_start",
+            "date_end",
+        ),
+    )
+
     calendar_id: int | None = Field(default=None, foreign_key="calendar.id")
     calendar: Calendar = Relationship(back_populates="events")
 
@@ -57,3 +94,25 @@ class EventPublic(EventBase):
 class CalendarPublic(CalendarBase):
     events: list[EventPublic] | None = None
     cleaning_dates: list[CleaningDatePublic] | None = None
+
+
+class CleaningDay(SQLModel):
+    date: datetime.date
+    # Calendars to clean on the day
+    calendars: list[CalendarBase]
+
+
+class CalendarImportResult(SQLModel):
+    # File name or URL
+    source: str
+    calendar: CalendarBase | None = None
+    # Same as the `detail` of the single item endpoints' errors
+    error: str | dict | None = None
+
+
+class RecalculationJobPublic(SQLModel):
+    id: str
+    status: str
+    created_at: datetime.datetime
+    finished_at: datetime.datetime | None = None
+    error: str | None = None
@@ -13,6 +13,8 @@ class UserBase(SQLModel):
 
 class User(UserBase, table=True):
     hashed_password: str
+    # Token in the URLs of the user's cleaning schedule feeds, only its hash is stored
+    feed_token_hash: str | None = Field(default=None, index=True)
     calendars: list["Calendar"] = Relationship(back_populates="user")
 
 
@@ -31,3 +33,7 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     username: str
+
+
+class FeedToken(BaseModel):
+    feed_token: str
@@ -0,0 +1,90 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any
+
+from fastapi import HTTPException
+
+from app import utils
+from app.config import settings
+
+
+_parse_pool: ProcessPoolExecutor | None = None
+
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    """
+    Processes for parsing big calendar files, which would otherwise hold the GIL (and
+    every other request) for seconds
+    """
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(
+            max_workers=settings.CALENDAR_PARSE_WORKERS,
+            # Forking a process with running threads isn't safe
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    return _parse_pool
+
+
+def start_parse_pool():
+    """
+    Start the worker processes ahead, so that the first big upload doesn't wait for them
+    """
+    if settings.CALENDAR_PARSE_WORKERS:
+        parse_pool = get_parse_pool()
+        for future in [
+            parse_pool.submit(int) for _ in range(settings.CALENDAR_PARSE_WORKERS)
+        ]:
+            future.result()
+
+
+class InvalidCalendarFile(Exception):
+    """
+    HTTPException of an invalid file, raised in a worker process. HTTPException itself
+    can't be unpickled, which would break the pool.
+    """
+
+    def __init__(self, status_code: int, detail: Any):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def read_calendar_in_worker(file: bytes) -> utils.ParsedCalendar:
+    try:
+        return utils.read_calendar(file)
+    except HTTPException as e:
+        raise InvalidCalendarFile(e.status_code, e.detail)
+
+
+def read_calendar(file: bytes) -> utils.ParsedCalendar:
+    """
+    Same as `utils.read_calendar`, but files of at least
+    `CALENDAR_PARSE_PROCESS_MIN_BYTES` are parsed in the process pool
+    """
+    if (
+        not settings.CALENDAR_PARSE_WORKERS
+        or len(file) < settings.CALENDAR_PARSE_PROCESS_MIN_BYTES
+    ):
+        return utils.read_calendar(file)
+
+    pool = get_parse_pool()
+    try:
+        # Events come back as tuples, which are cheap to pickle
+        return pool.submit(read_calendar_in_worker, file).result()
+    except InvalidCalendarFile as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except BrokenProcessPool:
+        # A worker died, later files get a new pool
+        if _parse_pool is pool:
+            close_parse_pool()
+        raise
+
+
+def close_parse_pool():
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(cancel_futures=True)
+        _parse_pool = None
@@ -0,0 +1,264 @@
+import datetime
+import logging
+import threading
+import time
+import uuid
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Literal, Protocol
+
+from sqlalchemy import Engine
+from sqlmodel import Session, col, select
+
+from app.cache import LRUCache
+from app.config import settings
+from app.crud import recalculate_cleaning_dates
+from app.models.calendars import Calendar
+from app.models.users import User
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(eq=False)
+class RecalculationJob:
+    """
+    Recalculation of a user's cleaning dates. Until it starts, later requests for the
+    same user are merged into it.
+    """
+
+    username: str
+    bind: Engine
+    # None recalculates the whole schedule
+    changed_calendar_ids: set[int] | None
+    # time.monotonic() after which the job may start
+    run_at: float
+    latest_run_at: float
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: Literal["queued", "running", "done", "failed"] = "queued"
+    created_at: datetime.datetime = field(
+        default_factory=lambda: datetime.datetime.now(datetime.timezone.utc)
+    )
+    finished_at: datetime.datetime | None = None
+    error: str | None = None
+
+    def merge(self, changed_calendar_ids: Iterable[int] | None, run_at: float):
+        if self.changed_calendar_ids is not None and changed_calendar_ids is not None:
+            self.changed_calendar_ids.update(changed_calendar_ids)
+        else:
+            self.changed_calendar_ids = None
+        self.run_at = min(run_at, self.latest_run_at)
+
+
+class JobBackend(Protocol):
+    # Whether jobs wait for their delay, during which requests are merged into them
+    delays_jobs: bool
+
+    def submit(self, function: Callable[[], None], delay_seconds: float) -> None: ...
+
+    def shutdown(self) -> None: ...
+
+
+class InlineJobBackend:
+    """
+    Runs jobs right away in the thread submitting them, without coalescing
+    """
+
+    delays_jobs = False
+
+    def submit(self, function: Callable[[], None], delay_seconds: float) -> None:
+        function()
+
+    def shutdown(self) -> None:
+        pass
+
+
+class ThreadJobBackend:
+    """
+    Runs jobs one at a time in a background thread, each after its delay
+    """
+
+    delays_jobs = True
+
+    def __init__(self):
+        self._executor: ThreadPoolExecutor | None = None
+        self._timers: set[threading.Timer] = set()
+        self._lock = threading.Lock()
+
+    def submit(self, function: Callable[[], None], delay_seconds: float) -> None:
+        if delay_seconds <= 0:
+            self._run(function)
+            return
+
+        timer = threading.Timer(delay_seconds, lambda: self._run(function, timer))
+        timer.daemon = True
+        with self._lock:
+            self._timers.add(timer)
+        timer.start()
+
+    def _run(
+        self, function: Callable[[], None], timer: threading.Timer | None = None
+    ) -> None:
+        with self._lock:
+            if timer is not None:
+                self._timers.discard(timer)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="recalculation"
+                )
+            self._executor.submit(function)
+
+    def shutdown(self) -> None:
+        """
+        Drop jobs waiting for their delay and wait for the ones already handed to
+        the worker
+        """
+        with self._lock:
+            for timer in self._timers:
+                timer.cancel()
+            self._timers.clear()
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown()
+
+
+def create_job_backend(name: str) -> JobBackend:
+    backends: dict[str, Callable[[], JobBackend]] = {
+        "inline": InlineJobBackend,
+        "thread": ThreadJobBackend,
+    }
+    if name not in backends:
+        raise ValueError(f"Unknown recalculation backend: {name}")
+
+    return backends[name]()
+
+
+class RecalculationQueue:
+    """
+    Recalculates cleaning dates in the background. Requests for a user arriving while
+    their job is still queued are merged into it, and the job waits until
+    `delay_seconds` pass without a new request (but at most `max_delay_seconds`), so a
+    burst of imports is recalculated once.
+    """
+
+    def __init__(
+        self, backend: JobBackend, delay_seconds: float, max_delay_seconds: float
+    ):
+        self.backend = backend
+        self.delay_seconds = delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        # Finished jobs stay around for status requests until they are pushed out
+        self.jobs: LRUCache[str, RecalculationJob] = LRUCache(
+            max_size=settings.RECALCULATION_JOBS_KEPT
+        )
+        self._queued: dict[tuple[Engine, str], RecalculationJob] = {}
+        self._lock = threading.Lock()
+        # Once shutting down, queued jobs run right away instead of waiting
+        self._draining = False
+
+    def enqueue(
+        self,
+        bind: Engine,
+        username: str,
+        changed_calendar_ids: Iterable[int] | None = None,
+    ) -> RecalculationJob:
+        """
+        Recalculate cleaning dates of the user, only around `changed_calendar_ids`
+        if given. Returns the job doing it.
+        """
+        delay_seconds, max_delay_seconds = (
+            (self.delay_seconds, self.max_delay_seconds)
+            if self.backend.delays_jobs
+            else (0, 0)
+        )
+        now = time.monotonic()
+        with self._lock:
+            job = self._queued.get((bind, username))
+            if job is not None:
+                job.merge(changed_calendar_ids, now + delay_seconds)
+                return job
+
+            job = RecalculationJob(
+                username=username,
+                bind=bind,
+                changed_calendar_ids=(
+                    None if changed_calendar_ids is None else set(changed_calendar_ids)
+                ),
+                run_at=now + delay_seconds,
+                latest_run_at=now + max_delay_seconds,
+            )
+            self._queued[(bind, username)] = job
+            self.jobs.set(job.id, job)
+
+        self.backend.submit(lambda: self._start(job), delay_seconds)
+        return job
+
+    def _start(self, job: RecalculationJob) -> None:
+        with self._lock:
+            if job.status != "queued":
+                # Already run on shutdown
+                return
+
+            delay_seconds = job.run_at - time.monotonic()
+            if delay_seconds <= 0 or self._draining:
+                delay_seconds = 0
+                del self._queued[(job.bind, job.username)]
+                job.status = "running"
+
+        if delay_seconds > 0:
+            # Requests merged in meanwhile pushed the start back
+            self.backend.submit(lambda: self._start(job), delay_seconds)
+            return
+
+        try:
+            run_job(job)
+            job.status = "done"
+        except Exception as e:
+            logger.exception("Recalculating cleaning dates of %s failed", job.username)
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = datetime.datetime.now(datetime.timezone.utc)
+
+    def get_job(self, job_id: str) -> RecalculationJob | None:
+        return self.jobs.get(job_id)
+
+    def shutdown(self) -> None:
+        """
+        Stop the backend, then run the jobs still waiting for their delay in this
+        thread, so imports made just before shutting down get their cleaning dates
+        """
+        with self._lock:
+            self._draining = True
+        self.backend.shutdown()
+
+        # Their timers were cancelled
+        with self._lock:
+            queued = list(self._queued.values())
+        for job in queued:
+            self._start(job)
+
+
+def run_job(job: RecalculationJob) -> None:
+    with Session(job.bind) as session:
+        user = session.get(User, job.username)
+        if user is None:
+            return
+
+        changed_calendars = None
+        if job.changed_calendar_ids is not None:
+            changed_calendars = session.exec(
+                select(Calendar).where(col(Calendar.id).in_(job.changed_calendar_ids))
+            ).all()
+
+        recalculate_cleaning_dates(session, user, changed_calendars)
+        session.commit()
+
+
+recalculation_queue = RecalculationQueue(
+    create_job_backend(settings.RECALCULATION_BACKEND),
+    delay_seconds=settings.RECALCULATION_DELAY_SECONDS,
+    max_delay_seconds=settings.RECALCULATION_MAX_DELAY_SECONDS,
+)
@@ -1,130 +1,660 @@
+import asyncio
+import base64
 import datetime
-from io import BytesIO
-from typing import Annotated, Optional
-
-import requests
-from fastapi import APIRouter, File, HTTPException, Query, status
+import logging
+import re
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
+from typing import Annotated, NamedTuple, Optional
+
+from fastapi import (
+    APIRouter,
+    File,
+    Form,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
 from pydantic import HttpUrl, ValidationError
-from sqlmodel import select
-
-from app import cleaning_algorithm
-from app import utils
-from app.crud import get_user_by_username
-from app.deps import CurrentUser, SessionDep
+from sqlalchemy import Engine, func
+from sqlmodel import Session, col, select
+
+from app import parse_pool, utils
+from app.cache import LRUCache
+from app.config import settings
+from app.crud import (
+    add_calendar,
+    find_uploaded_calendar,
+    get_calendar_by_url,
+    get_calendars_by_url,
+    store_calendar_file,
+    update_calendar_content,
+)
+from app.database import get_session_engine
+from app.deps import CurrentUser, FeedUser, HttpClientDep, SessionDep
 from app.models.calendars import (
     Calendar,
+    CalendarBase,
+    CalendarFile,
+    CalendarImportResult,
     CalendarPublic,
     CalendarUrlImport,
     CleaningDate,
+    CleaningDay,
+    Event,
+    RecalculationJobPublic,
 )
 from app.models.users import User
+from app.recalculation import recalculation_queue
 
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
+# User, calendar and when their cleaning dates changed -> iCalendar file
+cleaning_schedule_feeds: LRUCache[str, bytes] = LRUCache(
+    max_size=settings.CLEANING_SCHEDULE_FEED_CACHE_SIZE
+)
+
+# Routes that only talk to the database are plain functions, FastAPI runs them in its
+# threadpool so the blocking session calls don't hold up the event loop
+
 
 @router.get("/calendars/", response_model=list[CalendarPublic])
-async def get_calendars(
+def get_calendars(
     session: SessionDep,
     current_user: CurrentUser,
+    request: Request,
+    response: Response,
     from_date: Optional[datetime.date] = Query(default=None),
     to_date: Optional[datetime.date] = Query(default=None),
+    limit: Optional[int] = Query(
+        default=None, ge=1, le=settings.CALENDARS_PAGE_MAX_SIZE
+    ),
+    cursor: Optional[str] = Query(default=None),
+    include_events: bool = Query(default=True),
+    include_cleaning_dates: bool = Query(default=True),
 ):
-    user = get_user_by_username(session, current_user.username)
+    """
+    With `limit`, calendars are returned in pages and the `X-Next-Cursor` header is the
+    `cursor` for the next one. With `Accept: application/x-ndjson`, all calendars after
+    `cursor` are streamed instead, one JSON object per line.
+
+    Events are filtered by `from_date` and `to_date`, cleaning dates are only included
+    without them.
+    """
+    after_id = decode_cursor(cursor) if cursor else None
+    include_cleaning_dates = include_cleaning_dates and not (from_date or to_date)
+    load_page = partial(
+        load_calendars,
+        username=current_user.username,
+        from_date=from_date,
+        to_date=to_date,
+        include_events=include_events,
+        include_cleaning_dates=include_cleaning_dates,
+    )
 
-    if user is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
+    if "application/x-ndjson" in request.headers.get("Accept", ""):
+        return StreamingResponse(
+            stream_calendars(get_session_engine(session), load_page, after_id),
+            media_type="application/x-ndjson",
         )
 
-    if not (from_date or to_date):
-        return user.calendars
+    if limit is None:
+        return load_page(session, after_id=after_id)
+
+    # One more tells whether there is a next page
+    calendars = load_page(session, after_id=after_id, limit=limit + 1)
+    if len(calendars) > limit:
+        calendars = calendars[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(calendars[-1])
+
+    return calendars
+
+
+def load_calendars(
+    session: Session,
+    username: str,
+    from_date: datetime.date | None,
+    to_date: datetime.date | None,
+    include_events: bool,
+    include_cleaning_dates: bool,
+    after_id: int | None = None,
+    limit: int | None = None,
+) -> list[CalendarPublic]:
+    """
+    User's calendars in order of their ids, starting after `after_id`. Calendars,
+    their events and cleaning dates are loaded with one query each.
+    """
+    calendars_query = (
+        select(Calendar).where(Calendar.user_id == username).order_by(col(Calendar.id))
+    )
+    if after_id is not None:
+        calendars_query = calendars_query.where(col(Calendar.id) > after_id)
+    if limit is not None:
+        calendars_query = calendars_query.limit(limit)
+
+    calendars = session.exec(calendars_query).all()
+    if not calendars:
+        return []
+
+    # Calendars of the page are the user's ones in this id range
+    page_calendar_ids = (
+        Calendar.user_id == username,
+        col(Calendar.id) >= calendars[0].id,
+        col(Calendar.id) <= calendars[-1].id,
+    )
 
-    calendar_list = []
-    for calendar in user.calendars:
-        filtered_events = [
-            event
-            for event in calendar.events
-            if (not from_date or event.date_end >= from_date)
-            and (not to_date or event.date_start <= to_date)
-        ]
-        calendar_public = CalendarPublic(
-            **calendar.model_dump(), events=filtered_events
+    events_by_calendar = defaultdict(list)
+    if include_events:
+        events_query = (
+            select(Event)
+            .join(Calendar)
+            .where(*page_calendar_ids)
+            .order_by(col(Event.id))
+        )
+        if from_date:
+            events_query = events_query.where(Event.date_end >= from_date)
+        if to_date:
+            events_query = events_query.where(Event.date_start <= to_date)
+
+        for event in session.exec(events_query):
+            events_by_calendar[event.calendar_id].append(event)
+
+    cleaning_dates_by_calendar = defaultdict(list)
+    if include_cleaning_dates:
+        cleaning_dates_query = (
+            select(CleaningDate)
+            .join(Calendar)
+            .where(*page_calendar_ids)
+            .order_by(col(CleaningDate.id))
+        )
+        for cleaning_date in session.exec(cleaning_dates_query):
+            cleaning_dates_by_calendar[cleaning_date.calendar_id].append(cleaning_date)
+
+    return [
+        CalendarPublic(
+            **calendar.model_dump(),
+            events=events_by_calendar[calendar.id] if include_events else None,
+            cleaning_dates=(
+                cleaning_dates_by_calendar[calendar.id]
+                if include_cleaning_dates
+                else None
+            ),
+        )
+        for calendar in calendars
+    ]
+
+
+def stream_calendars(
+    bind: Engine, load_page: Callable[..., list[CalendarPublic]], after_id: int | None
+) -> Iterator[str]:
+    """
+    Calendars as lines of JSON, loaded `CALENDARS_STREAM_BATCH_SIZE` at a time so that
+    only one batch is in memory
+    """
+    # Request's session is closed once the response starts
+    with Session(bind) as session:
+        while True:
+            calendars = load_page(
+                session, after_id=after_id, limit=settings.CALENDARS_STREAM_BATCH_SIZE
+            )
+            for calendar in calendars:
+                yield calendar.model_dump_json() + "\n"
+
+            session.expunge_all()
+            if len(calendars) < settings.CALENDARS_STREAM_BATCH_SIZE:
+                return
+            after_id = calendars[-1].id
+
+
+def encode_cursor(calendar: CalendarPublic) -> str:
+    """
+    Cursor of the calendars after this one
+    """
+    return base64.urlsafe_b64encode(str(calendar.id).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid cursor"
         )
-
-        calendar_list.append(calendar_public)
-
-    return calendar_list
 
 
 @router.get("/calendars/{calendar_id}/")
-def download_calendar(session: SessionDep, current_user: CurrentUser, calendar_id: int):
+def download_calendar(
+    request: Request, session: SessionDep, current_user: CurrentUser, calendar_id: int
+):
+    """
+    Calendar file, with support for conditional requests, gzip and byte ranges, so that
+    calendar apps polling it get a 304 most of the time
+    """
     calendar = session.get(Calendar, calendar_id)
     if calendar is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="No calendar with that id"
         )
 
-    if calendar.user != get_user_by_username(session, current_user.username):
+    if calendar.user_id != current_user.username:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Calendar doesn't belong to that user",
         )
 
-    if not calendar.content:
+    if not calendar.content_hash:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Calendar has no content"
         )
 
-    file_stream = BytesIO(calendar.content)
+    etag = f'"{calendar.content_hash}"'
+    # Compressed file is a different representation, so it needs its own ETag
+    gzip_etag = f'"{calendar.content_hash}-gzip"'
+    use_gzip = accepts_gzip(request) and "Range" not in request.headers
+
+    headers = {
+        "ETag": gzip_etag if use_gzip else etag,
+        "Cache-Control": "private, no-cache",
+        "Vary": "Accept-Encoding",
+        "Content-Disposition": f"attachment; filename=calendar_{calendar_id}.ics",
+    }
+    if calendar.updated_at:
+        headers["Last-Modified"] = http_date(calendar.updated_at)
+
+    # Answered from the calendar row alone, without loading the file
+    if is_not_modified(request, [etag, gzip_etag], calendar.updated_at):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    calendar_file = session.get(CalendarFile, calendar.content_hash)
+    if calendar_file is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Calendar has no content"
+        )
+
+    if use_gzip:
+        # Stored compressed already
+        return Response(
+            calendar_file.data,
+            media_type="text/calendar",
+            headers={**headers, "Content-Encoding": "gzip"},
+        )
 
-    response = StreamingResponse(file_stream, media_type="text/calendar")
-    response.headers["Content-Disposition"] = (
-        f"attachment; filename=calendar_{calendar_id}.ics"
+    headers["Accept-Ranges"] = "bytes"
+
+    byte_range = None
+    if_range = request.headers.get("If-Range")
+    if if_range is None or if_range == etag:
+        byte_range = parse_range(request.headers.get("Range"), calendar_file.size)
+
+    if byte_range is not None:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{calendar_file.size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            utils.iter_decompressed_range(calendar_file.data, start, end),
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            media_type="text/calendar",
+            headers=headers,
+        )
+
+    # Decompressed a chunk at a time while it's sent
+    headers["Content-Length"] = str(calendar_file.size)
+    return StreamingResponse(
+        utils.iter_decompressed(calendar_file.data),
+        media_type="text/calendar",
+        headers=headers,
     )
-    return response
 
 
-@router.post("/import-calendar/", response_model=CalendarPublic)
-async def upload_calendar(
-    session: SessionDep, current_user: CurrentUser, file: Annotated[bytes, File()]
+def http_date(value: datetime.datetime) -> str:
+    # SQLite gives back naive datetimes, they are all UTC
+    return format_datetime(value.replace(tzinfo=datetime.timezone.utc), usegmt=True)
+
+
+def is_not_modified(
+    request: Request, etags: list[str], last_modified: datetime.datetime | None
+) -> bool:
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        request_etags = {
+            tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+        }
+        return any(etag in request_etags for etag in etags)
+
+    if_modified_since = request.headers.get("If-Modified-Since")
+    if if_modified_since is None or last_modified is None:
+        return False
+
+    try:
+        modified_since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if modified_since.tzinfo is None:
+        modified_since = modified_since.replace(tzinfo=datetime.timezone.utc)
+
+    # HTTP dates don't have fractions of a second
+    last_modified = last_modified.replace(tzinfo=datetime.timezone.utc, microsecond=0)
+    return last_modified <= modified_since
+
+
+def accepts_gzip(request: Request) -> bool:
+    """
+    Whether the client takes gzip. An explicit gzip entry wins over `*`, wherever it is
+    in the header.
+    """
+    qualities = {}
+    for coding in request.headers.get("Accept-Encoding", "").split(","):
+        name, _, parameters = coding.partition(";")
+        parameters = parameters.strip()
+        try:
+            quality = float(parameters.removeprefix("q=")) if parameters else 1.0
+        except ValueError:
+            quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+def parse_range(range_header: str | None, size: int) -> tuple[int, int] | None:
+    """
+    First and last byte of a single range request. Requests for more ranges (or other
+    units) get the whole file, which is allowed, and so do invalid ranges, which must
+    be ignored.
+    """
+    if range_header is None or not range_header.startswith("bytes="):
+        return None
+
+    ranges = range_header.removeprefix("bytes=").split(",")
+    if len(ranges) != 1:
+        return None
+
+    byte_range = re.fullmatch(r"(\d*)-(\d*)", ranges[0].strip())
+    if byte_range is None or byte_range.groups() == ("", ""):
+        return None
+
+    first, last = byte_range.groups()
+    if not first:
+        # Last `last` bytes
+        start, end = max(size - int(last), 0), size - 1
+    elif last and int(last) < int(first):
+        return None
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+
+    if start > end or start >= size:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+
+    return start, end
+
+
+@router.get("/cleaning-dates/", response_model=list[CleaningDay])
+def get_cleaning_dates(
+    session: SessionDep,
+    current_user: CurrentUser,
+    from_date: datetime.date = Query(),
+    to_date: datetime.date = Query(),
+):
+    """
+    Days from `from_date` to `to_date` with something to clean, and the calendars
+    to clean on each
+    """
+    if to_date < from_date:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="to_date is before from_date",
+        )
+
+    return load_cleaning_days(session, current_user.username, from_date, to_date)
+
+
+def load_cleaning_days(
+    session: Session, username: str, from_date: datetime.date, to_date: datetime.date
+) -> list[dict]:
+    """
+    One query, reading each of the user's calendars' cleaning dates in the range
+    straight from the (calendar_id, date) index. Rows skip the ORM and days are plain
+    dicts, building thousands of models would take longer than the query.
+    """
+    query = (
+        select(
+            col(CleaningDate.date),
+            col(Calendar.id),
+            col(Calendar.name),
+            col(Calendar.url),
+        )
+        .join(Calendar)
+        .where(
+            Calendar.user_id == username,
+            col(CleaningDate.date) >= from_date,
+            col(CleaningDate.date) <= to_date,
+        )
+        .order_by(col(CleaningDate.date), col(Calendar.id))
+    )
+
+    return [
+        {
+            "date": date,
+            "calendars": [
+                {"id": calendar_id, "name": name, "url": url}
+                for _, calendar_id, name, url in rows
+            ],
+        }
+        for date, rows in groupby(
+            session.connection().execute(query), key=itemgetter(0)
+        )
+    ]
+
+
+@router.get("/cleaning-schedule/")
+def get_cleaning_schedule(
+    request: Request, session: SessionDep, current_user: CurrentUser
+):
+    """
+    Cleaning dates of all user's calendars as an iCalendar feed
+    """
+    return cleaning_schedule_response(request, session, current_user)
+
+
+@router.get("/calendars/{calendar_id}/cleaning-schedule/")
+def get_calendar_cleaning_schedule(
+    request: Request, session: SessionDep, current_user: CurrentUser, calendar_id: int
+):
+    check_calendar_owner(session, current_user, calendar_id)
+    return cleaning_schedule_response(request, session, current_user, calendar_id)
+
+
+# Calendar apps subscribing to a feed can't send an Authorization header, so these
+# take the user's feed token (see POST /feed-token) in the URL instead
+
+
+@router.get("/feeds/{feed_token}/cleaning-schedule/")
+def get_cleaning_schedule_feed(
+    request: Request, session: SessionDep, feed_user: FeedUser
 ):
-    calendar = utils.parse_calendar(file)
+    return cleaning_schedule_response(request, session, feed_user)
 
-    user = get_user_by_username(session, current_user.username)
-    if user is None:
+
+@router.get("/feeds/{feed_token}/calendars/{calendar_id}/cleaning-schedule/")
+def get_calendar_cleaning_schedule_feed(
+    request: Request, session: SessionDep, feed_user: FeedUser, calendar_id: int
+):
+    check_calendar_owner(session, feed_user, calendar_id)
+    return cleaning_schedule_response(request, session, feed_user, calendar_id)
+
+
+def check_calendar_owner(session: Session, user: User, calendar_id: int) -> None:
+    calendar = session.get(Calendar, calendar_id)
+    if calendar is None:
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail="No user with that username"
+            status_code=status.HTTP_404_NOT_FOUND, detail="No calendar with that id"
         )
 
-    calendar.user = user
-    session.add(calendar)
-    session.commit()
+    if calendar.user_id != user.username:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Calendar doesn't belong to that user",
+        )
 
-    # First delete all cleaning dates for calendars belonging to this user
-    cleaning_dates_user = session.exec(
-        select(CleaningDate).join(Calendar).where(Calendar.user == user)
+
+def cleaning_schedule_response(
+    request: Request, session: Session, user: User, calendar_id: int | None = None
+) -> Response:
+    """
+    Feeds are cached by when the cleaning dates were last recalculated, so the cleaning
+    dates are only read when they changed
+    """
+    calendars_query = select(
+        func.max(col(Calendar.cleaning_dates_updated_at)), func.count()
+    ).where(Calendar.user_id == user.username)
+    if calendar_id is not None:
+        calendars_query = calendars_query.where(Calendar.id == calendar_id)
+    cleaning_dates_updated_at, calendar_count = session.exec(calendars_query).one()
+
+    feed_key = (
+        f"{user.username}/{calendar_id}/{calendar_count}/{cleaning_dates_updated_at}"
     )
-    for date in cleaning_dates_user:
-        session.delete(date)
-    session.commit()
+    headers = {
+        "ETag": f'"{utils.content_hash(feed_key.encode("utf-8"))}"',
+        "Cache-Control": "private, no-cache",
+    }
+    if is_not_modified(request, [headers["ETag"]], None):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    feed = cleaning_schedule_feeds.get(feed_key)
+    if feed is None:
+        query = (
+            select(col(Calendar.id), col(Calendar.name), col(CleaningDate.date))
+            .join(CleaningDate)
+            .where(Calendar.user_id == user.username)
+            .order_by(col(CleaningDate.date), col(Calendar.id))
+        )
+        if calendar_id is not None:
+            query = query.where(Calendar.id == calendar_id)
+
+        cleanings = [utils.ScheduledCleaning._make(row) for row in session.exec(query)]
+        feed = utils.create_cleaning_schedule(cleanings)
+        cleaning_schedule_feeds.set(feed_key, feed)
+
+    return Response(feed, media_type="text/calendar", headers=headers)
+
+
+@router.post("/import-calendar/", response_model=CalendarPublic)
+def upload_calendar(
+    session: SessionDep,
+    current_user: CurrentUser,
+    response: Response,
+    file: Annotated[bytes, File()],
+    upsert: bool = Query(default=False),
+):
+    """
+    With `upsert`, calendar with the same PRODID is updated instead of adding a new one
+
+    Cleaning dates are recalculated in the background, by the job in the
+    `X-Recalculation-Job` header
+    """
+    if upsert:
+        calendar = find_uploaded_calendar(
+            session, current_user, content_hash=utils.content_hash(file)
+        )
+        if calendar is not None:
+            # Same file was already uploaded, there's nothing to write
+            return calendar
 
-    # Recalculate cleaning times
-    all_calendars = session.exec(select(Calendar).where(Calendar.user == user)).all()
-    cleaning_times = cleaning_algorithm.calculate_cleaning_times(all_calendars)
+    parsed_calendar = parse_pool.read_calendar(file)
 
-    for time in cleaning_times:
-        session.add(time)
+    if upsert:
+        calendar = find_uploaded_calendar(
+            session, current_user, name=parsed_calendar.name
+        )
+        if calendar is not None:
+            update_calendar_content(session, calendar, file, parsed_calendar.events)
+            session.commit()
+
+            # Removed events change cleaning dates outside of the new events' range too
+            enqueue_recalculation(session, current_user, response)
+            return calendar
+
+    calendar = Calendar(
+        name=parsed_calendar.name,
+        content_hash=store_calendar_file(session, file),
+        user=current_user,
+    )
+    add_calendar(session, calendar, parsed_calendar.events)
     session.commit()
 
+    # Only cleaning dates around the new calendar's events can change
+    enqueue_recalculation(session, current_user, response, [calendar])
+
     return calendar
 
 
+def enqueue_recalculation(
+    session: Session,
+    current_user: User,
+    response: Response,
+    changed_calendars: list[Calendar] | None = None,
+) -> None:
+    """
+    Recalculate cleaning dates after the import was committed, jobs of imports in
+    quick succession are merged
+    """
+    changed_calendar_ids = (
+        None
+        if changed_calendars is None
+        else [calendar.id for calendar in changed_calendars if calendar.id is not None]
+    )
+    job = recalculation_queue.enqueue(
+        get_session_engine(session), current_user.username, changed_calendar_ids
+    )
+    response.headers["X-Recalculation-Job"] = job.id
+
+
+@router.get("/recalculation-jobs/{job_id}/", response_model=RecalculationJobPublic)
+def get_recalculation_job(current_user: CurrentUser, job_id: str):
+    job = recalculation_queue.get_job(job_id)
+    if job is None or job.username != current_user.username:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No recalculation job with that id",
+        )
+
+    return RecalculationJobPublic.model_validate(job, from_attributes=True)
+
+
 @router.post("/import-from-url/", response_model=CalendarPublic)
 async def import_calendar_from_url(
-    session: SessionDep, current_user: CurrentUser, calendar_url: CalendarUrlImport
+    session: SessionDep,
+    current_user: CurrentUser,
+    http_client: HttpClientDep,
+    response: Response,
+    calendar_url: CalendarUrlImport,
+    upsert: bool = Query(default=False),
 ):
+    """
+    With `upsert`, calendar imported from the same URL is updated instead of adding a
+    new one
+
+    Cleaning dates are recalculated in the background, like for uploads
+    """
     try:
         HttpUrl(calendar_url.url)
     except ValidationError as e:
@@ -132,26 +662,299 @@ async def import_calendar_from_url(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Invalid URL: {e}"
         )
 
-    user = get_user_by_username(session, current_user.username)
-    if user is None:
+    calendar = None
+    headers = None
+    if upsert:
+        calendar = await run_in_threadpool(
+            get_calendar_by_url, session, current_user, calendar_url.url
+        )
+        if calendar is not None:
+            headers = utils.conditional_request_headers(calendar)
+
+    fetched = await utils.fetch_calendar(http_client, calendar_url.url, headers)
+
+    # Parsing and saving block, so they run in the threadpool like the other routes
+    return await run_in_threadpool(
+        save_calendar_from_url,
+        session,
+        current_user,
+        response,
+        calendar_url.url,
+        fetched,
+        calendar,
+    )
+
+
+def save_calendar_from_url(
+    session: Session,
+    current_user: User,
+    response: Response,
+    url: str,
+    fetched: utils.FetchedCalendar,
+    calendar: Calendar | None = None,
+) -> CalendarPublic:
+    if calendar is not None:
+        content_changed = update_calendar_from_url(session, calendar, fetched)
+        session.commit()
+        if content_changed:
+            enqueue_recalculation(session, current_user, response)
+        return CalendarPublic.model_validate(calendar)
+
+    if fetched.content is None:
+        # Without stored validators the request wasn't conditional
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="No user with that username"
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Cannot get file from {url}: unexpected 304 response",
         )
 
-    try:
-        response = requests.get(calendar_url.url).content
-    except Exception as e:
+    parsed_calendar = parse_pool.read_calendar(fetched.content)
+
+    calendar = Calendar(
+        name=parsed_calendar.name,
+        content_hash=store_calendar_file(session, fetched.content),
+        url=url,
+        etag=fetched.etag,
+        last_modified=fetched.last_modified,
+        user=current_user,
+    )
+    add_calendar(session, calendar, parsed_calendar.events)
+    session.commit()
+
+    enqueue_recalculation(session, current_user, response, [calendar])
+
+    # Serialized here, loading the events would otherwise block the event loop
+    return CalendarPublic.model_validate(calendar)
+
+
+# Error of items that failed unexpectedly, details are only logged
+BATCH_ITEM_ERROR = "Calendar could not be read"
+
+
+class BatchImportItem(NamedTuple):
+    """
+    File or URL to save as a new calendar, unless `upsert` finds it was imported before
+    """
+
+    # File name or URL
+    source: str
+    content: bytes
+    parsed: utils.ParsedCalendar
+    url: str | None = None
+    fetched: utils.FetchedCalendar | None = None
+
+
+class BatchUpdateItem(NamedTuple):
+    """
+    URL imported before, fetched again for `upsert`
+    """
+
+    url: str
+    calendar: Calendar
+    fetched: utils.FetchedCalendar
+    # None when the file didn't change
+    parsed: utils.ParsedCalendar | None = None
+
+
+@router.post("/import-calendars/", response_model=list[CalendarImportResult])
+async def import_calendars(
+    session: SessionDep,
+    current_user: CurrentUser,
+    http_client: HttpClientDep,
+    response: Response,
+    files: list[UploadFile] = File(default=[]),
+    urls: list[str] = Form(default=[]),
+    upsert: bool = Query(default=False),
+):
+    """
+    Import many calendar files and URLs at once. They are fetched and parsed
+    concurrently, saved in one transaction and cleaning dates are recalculated once.
+
+    Results list the files in the order they were sent, then the URLs. Items that
+    can't be imported get an error in their result, the rest are imported anyway.
+    Repeated files and URLs are imported once. With `upsert`, calendars imported before
+    are updated like in `/import-calendar/` and `/import-from-url/`.
+    """
+    item_count = len(files) + len(urls)
+    if not item_count or item_count > settings.CALENDAR_BATCH_MAX_ITEMS:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=f"Cannot get file from {calendar_url.url}: {e}",
+            detail=f"Between 1 and {settings.CALENDAR_BATCH_MAX_ITEMS} files and URLs "
+            "can be imported at once",
+        )
+
+    unique_urls = list(dict.fromkeys(urls))
+    url_calendars = {}
+    if upsert:
+        url_calendars = await run_in_threadpool(
+            get_calendars_by_url, session, current_user, unique_urls
         )
 
-    calendar = utils.parse_calendar(response)
+    semaphore = asyncio.Semaphore(settings.CALENDAR_BATCH_FETCH_CONCURRENCY)
+
+    async def load_file(file: UploadFile) -> BatchImportItem | CalendarImportResult:
+        source = file.filename or "file"
+        content = await file.read()
+        try:
+            parsed = await run_in_threadpool(parse_pool.read_calendar, content)
+        except HTTPException as e:
+            return CalendarImportResult(source=source, error=e.detail)
+        except Exception:
+            # Only this item fails, the rest of the batch is imported
+            logger.exception("Reading %s in a batch import failed", source)
+            return CalendarImportResult(source=source, error=BATCH_ITEM_ERROR)
+
+        return BatchImportItem(source, content, parsed)
+
+    async def load_url(
+        url: str,
+    ) -> BatchImportItem | BatchUpdateItem | CalendarImportResult:
+        calendar = url_calendars.get(url)
+        headers = utils.conditional_request_headers(calendar) if calendar else None
+        try:
+            HttpUrl(url)
+            async with semaphore:
+                fetched = await utils.fetch_calendar(http_client, url, headers)
+
+            if calendar is not None:
+                parsed = None
+                if (
+                    fetched.content is not None
+                    and utils.content_hash(fetched.content) != calendar.content_hash
+                ):
+                    parsed = await run_in_threadpool(
+                        parse_pool.read_calendar, fetched.content
+                    )
+                return BatchUpdateItem(url, calendar, fetched, parsed)
+
+            if fetched.content is None:
+                return CalendarImportResult(
+                    source=url,
+                    error=f"Cannot get file from {url}: unexpected 304 response",
+                )
+            parsed = await run_in_threadpool(parse_pool.read_calendar, fetched.content)
+        except ValidationError as e:
+            return CalendarImportResult(source=url, error=f"Invalid URL: {e}")
+        except HTTPException as e:
+            return CalendarImportResult(source=url, error=e.detail)
+        except Exception:
+            logger.exception("Reading %s in a batch import failed", url)
+            return CalendarImportResult(source=url, error=BATCH_ITEM_ERROR)
+
+        return BatchImportItem(url, fetched.content, parsed, url, fetched)
+
+    loaded = await asyncio.gather(
+        *(load_file(file) for file in files), *(load_url(url) for url in unique_urls)
+    )
+    # Repeated URLs were fetched once
+    loaded_urls = dict(zip(unique_urls, loaded[len(files) :]))
+    items = [*loaded[: len(files)], *(loaded_urls[url] for url in urls)]
+
+    return await run_in_threadpool(
+        save_calendar_batch, session, current_user, response, items, upsert
+    )
+
 
-    calendar.user = user
-    calendar.url = calendar_url.url
+def save_calendar_batch(
+    session: Session,
+    current_user: User,
+    response: Response,
+    items: list[BatchImportItem | BatchUpdateItem | CalendarImportResult],
+    upsert: bool,
+) -> list[CalendarImportResult]:
+    results = []
+    new_calendars = []
+    content_changed = False
+    # Calendars saved for each URL and file hash, repeated items get the same one
+    saved: dict[str, Calendar] = {}
+    for item in items:
+        if isinstance(item, CalendarImportResult):
+            # Couldn't be fetched or parsed
+            results.append(item)
+            continue
+
+        if isinstance(item, BatchUpdateItem):
+            source = key = item.url
+        else:
+            source = item.source
+            key = item.url or utils.content_hash(item.content)
+
+        if key in saved:
+            # Same file or URL earlier in the batch
+            calendar = saved[key]
+        elif isinstance(item, BatchUpdateItem):
+            calendar = item.calendar
+            content_changed |= update_calendar_from_url(
+                session, calendar, item.fetched, item.parsed
+            )
+        else:
+            existing = None
+            if upsert and item.url is None:
+                existing = find_uploaded_calendar(
+                    session, current_user, content_hash=key
+                ) or find_uploaded_calendar(
+                    session, current_user, name=item.parsed.name
+                )
+
+            if existing is not None:
+                calendar = existing
+                if calendar.content_hash != key:
+                    update_calendar_content(
+                        session, calendar, item.content, item.parsed.events
+                    )
+                    content_changed = True
+            else:
+                calendar = Calendar(
+                    name=item.parsed.name,
+                    content_hash=store_calendar_file(session, item.content),
+                    url=item.url,
+                    etag=item.fetched.etag if item.fetched else None,
+                    last_modified=item.fetched.last_modified if item.fetched else None,
+                    user=current_user,
+                )
+                add_calendar(session, calendar, item.parsed.events)
+                new_calendars.append(calendar)
+
+        saved[key] = calendar
+        results.append(
+            CalendarImportResult(
+                source=source, calendar=CalendarBase.model_validate(calendar)
+            )
+        )
 
+    if saved:
+        session.commit()
+    if content_changed:
+        # Removed events change cleaning dates outside of the new events' range too
+        enqueue_recalculation(session, current_user, response)
+    elif new_calendars:
+        enqueue_recalculation(session, current_user, response, new_calendars)
+
+    return results
+
+
+def update_calendar_from_url(
+    session: Session,
+    calendar: Calendar,
+    fetched: utils.FetchedCalendar,
+    parsed_calendar: utils.ParsedCalendar | None = None,
+) -> bool:
+    """
+    Returns whether the content changed. `parsed_calendar` is the fetched file, if it
+    was parsed already. Nothing is committed.
+    """
+    # 304 responses don't have to repeat the validators
+    calendar.etag = fetched.etag or calendar.etag
+    calendar.last_modified = fetched.last_modified or calendar.last_modified
     session.add(calendar)
-    session.commit()
 
-    return calendar
+    if (
+        fetched.content is None
+        or utils.content_hash(fetched.content) == calendar.content_hash
+    ):
+        return False
+
+    if parsed_calendar is None:
+        parsed_calendar = parse_pool.read_calendar(fetched.content)
+    update_calendar_content(session, calendar, fetched.content, parsed_calendar.events)
+
+    return True
@@ -1,13 +1,19 @@
 from datetime import timedelta
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
 
-from app.deps import SessionDep
+from app.deps import CurrentUser, SessionDep
 from app.config import settings
-from app.models.users import Token, UserCreate, UserPublic
-from app.security import create_access_token
+from app.models.users import FeedToken, Token, UserCreate, UserPublic
+from app.security import (
+    create_access_token,
+    create_feed_token,
+    hash_feed_token,
+    hash_password,
+)
 from app.crud import create_user, authenticate_user, get_user_by_username
 
 router = APIRouter()
@@ -20,7 +26,8 @@ USERNAME_PASSWORD_MIN_LEN = 3
 async def login_for_access_token(
     session: SessionDep, form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
 ) -> Token:
-    user = authenticate_user(session, form_data.username, form_data.password)
+    # Coroutine, so waiting for bcrypt doesn't take a thread from the threadpool
+    user = await authenticate_user(session, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -46,12 +53,36 @@ async def register(session: SessionDep, user_create: UserCreate):
             detail=f"Username and password must be at least {USERNAME_PASSWORD_MIN_LEN} characters long",
         )
 
-    user = get_user_by_username(session, user_create.username)
+    user = await run_in_threadpool(get_user_by_username, session, user_create.username)
     if user is not None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="User already exists"
         )
 
-    user = create_user(session=session, user_create=user_create)
+    hashed_password = await hash_password(user_create.password)
+    user = await run_in_threadpool(create_user, session, user_create, hashed_password)
 
     return user
+
+
+@router.post("/feed-token", response_model=FeedToken)
+def replace_feed_token(session: SessionDep, current_user: CurrentUser) -> FeedToken:
+    """
+    New token for the cleaning schedule feed URLs, `/feeds/{feed_token}/...`. Feed URLs
+    with the previous token stop working.
+    """
+    feed_token = create_feed_token()
+    current_user.feed_token_hash = hash_feed_token(feed_token)
+    session.add(current_user)
+    session.commit()
+
+    return FeedToken(feed_token=feed_token)
+
+
+@router.delete("/feed-token", status_code=status.HTTP_204_NO_CONTENT)
+def revoke_feed_token(session: SessionDep, current_user: CurrentUser):
+    current_user.feed_token_hash = None
+    session.add(current_user)
+    session.commit()
+
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
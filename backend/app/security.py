@@ -1,12 +1,32 @@
+import asyncio
+import hashlib
+import secrets
+import threading
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from typing import TypeVar
 
 import jwt
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
 
 from app.config import settings
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS
+)
+
+# bcrypt gets its own threads, so a burst of logins can't take up FastAPI's threadpool
+password_executor = ThreadPoolExecutor(
+    max_workers=settings.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash"
+)
+password_slots = threading.BoundedSemaphore(
+    settings.PASSWORD_HASH_WORKERS + settings.PASSWORD_HASH_QUEUE_SIZE
+)
+
+T = TypeVar("T")
 
 ALGORITHM = "HS256"
 
@@ -19,9 +39,56 @@ def create_access_token(data: dict, expires_delta: timedelta) -> str:
     return encoded_jwt
 
 
+def create_feed_token() -> str:
+    return secrets.token_urlsafe(32)
+
+
+def hash_feed_token(feed_token: str) -> str:
+    # Tokens are random, unlike passwords, so a fast hash is enough
+    return hashlib.sha256(feed_token.encode("utf-8")).hexdigest()
+
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
+
+
+async def run_password_work(function: Callable[..., T], *args) -> T:
+    """
+    Run `function` in the password executor, or refuse with 503 when too many are
+    waiting
+    """
+    if not password_slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login attempts, try again later",
+            headers={"Retry-After": "1"},
+        )
+
+    try:
+        future = password_executor.submit(function, *args)
+    except RuntimeError:
+        password_slots.release()
+        raise
+
+    # Released when the work is done, even if the request was cancelled meanwhile
+    future.add_done_callback(lambda _: password_slots.release())
+    return await asyncio.wrap_future(future)
+
+
+async def hash_password(password: str) -> str:
+    return await run_password_work(get_password_hash, password)
+
+
+async def verify_and_update_password(
+    plain_password: str, hashed_password: str
+) -> tuple[bool, str | None]:
+    """
+    Check the password, and also return a new hash if the old one used other settings
+    """
+    return await run_password_work(
+        pwd_context.verify_and_update, plain_password, hashed_password
+    )
@@ -0,0 +1,49 @@
+import datetime
+
+import pytest
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: asserts timings, only run with `-m benchmark`"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    # Timings depend on the machine and its load, so they stay out of the default run
+    if "benchmark" in config.getoption("markexpr"):
+        return
+
+    skip_benchmark = pytest.mark.skip(reason="benchmark, run with `-m benchmark`")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
+
+
+def make_big_calendar(event_count: int) -> bytes:
+    """
+    Calendar file with `event_count` non-overlapping events, like big channel manager
+    exports
+    """
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID: big export"]
+    day = datetime.date(2020, 1, 1)
+    for i in range(event_count):
+        lines += [
+            "BEGIN:VEVENT",
+            f"DTSTART;VALUE=DATE:{day:%Y%m%d}",
+            f"DTEND;VALUE=DATE:{day + datetime.timedelta(days=2):%Y%m%d}",
+            f"UID:{i:032x}",
+            f"SUMMARY: Guest {i}",
+            "DESCRIPTION:Reservation made through a channel manager, this line is long",
+            "  enough to be folded",
+            "END:VEVENT",
+        ]
+        day += datetime.timedelta(days=3)
+    lines.append("END:VCALENDAR")
+
+    return "\r\n".join(lines).encode("utf-8")
+
+
+@pytest.fixture
+def big_calendar():
+    return make_big_calendar
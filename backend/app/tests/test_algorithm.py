@@ -1,13 +1,31 @@
 import pytest
 
-from app.cleaning_algorithm import calculate_cleaning_times
+from app import cleaning_algorithm
+from app.cleaning_algorithm import (
+    CleaningBuffer,
+    buffer_cache,
+    calculate_cleaning_dates,
+    calculate_cleaning_times,
+    create_cleaning_buffer_columns,
+    create_cleaning_buffers,
+    find_affected_window,
+    find_cleaning_dates,
+    find_cleaning_dates_vectorized,
+    schedule_cache,
+)
 from app.models.calendars import Calendar, Event, CleaningDate
 import datetime
+import random
+import time
+import tracemalloc
+from dataclasses import dataclass
+from types import SimpleNamespace
 
 
 def test_empty():
     calendars = []
     assert calculate_cleaning_times(calendars) == []
+    assert calculate_cleaning_times(calendars, vectorized=True) == []
 
 
 def test_one_calendar_one_event():
@@ -276,3 +294,257 @@ def test_multiple_calendars_multiple_events():
         CleaningDate(date=datetime.date(2024, 10, 8), calendar_id=3),
         CleaningDate(date=datetime.date(2024, 10, 10), calendar_id=4),
     ]
+
+
+def calculate_cleaning_times_reference(calendars):
+    """
+    Original quadratic greedy loop, kept to check the sweep against
+    """
+    cleaning_buffers = create_cleaning_buffers(calendars)
+    not_cleaned_buffers = list(cleaning_buffers)
+
+    cleaning_times = []
+    while not_cleaned_buffers:
+        first_expiring = min(not_cleaned_buffers, key=lambda buffer: buffer.end)
+
+        still_not_cleaned = []
+        for buffer in not_cleaned_buffers:
+            if (
+                buffer.start <= first_expiring.end
+                and buffer.end >= first_expiring.start
+            ):
+                cleaning_times.append(
+                    CleaningDate(
+                        calendar_id=buffer.calendar_id, date=first_expiring.end
+                    )
+                )
+            else:
+                still_not_cleaned.append(buffer)
+        not_cleaned_buffers = still_not_cleaned
+
+    return cleaning_times
+
+
+def random_calendars(rng, calendar_count, max_events):
+    calendars = []
+    for calendar_id in range(1, calendar_count + 1):
+        events = []
+        day = datetime.date(2024, 1, 1) + datetime.timedelta(days=rng.randint(0, 10))
+        for _ in range(rng.randint(0, max_events)):
+            start = day + datetime.timedelta(days=rng.randint(0, 4))
+            end = start + datetime.timedelta(days=rng.randint(1, 7))
+            events.append(Event(date_start=start, date_end=end))
+            day = end
+
+        rng.shuffle(events)
+        calendars.append(Calendar(id=calendar_id, events=events))
+
+    return calendars
+
+
+def test_matches_reference_on_random_calendars():
+    rng = random.Random(31)
+
+    for _ in range(300):
+        calendars = random_calendars(
+            rng, calendar_count=rng.randint(1, 8), max_events=rng.randint(0, 15)
+        )
+        expected = calculate_cleaning_times_reference(calendars)
+
+        assert calculate_cleaning_times(calendars) == expected
+        assert calculate_cleaning_times(calendars, vectorized=True) == expected
+
+
+def test_incremental_matches_full_recalculation():
+    rng = random.Random(7)
+
+    for _ in range(300):
+        calendars = random_calendars(
+            rng, calendar_count=rng.randint(1, 8), max_events=rng.randint(0, 15)
+        )
+        previous_schedule = calculate_cleaning_times(calendars[:-1])
+
+        window = find_affected_window(calendars, calendars[-1:])
+        if window is None:
+            schedule = previous_schedule
+        else:
+            window_start, window_end = window
+            schedule = [
+                cleaning_date
+                for cleaning_date in previous_schedule
+                if not window_start <= cleaning_date.date <= window_end
+            ] + calculate_cleaning_times(calendars, window)
+
+        def key(cleaning_date):
+            return (cleaning_date.date, cleaning_date.calendar_id)
+
+        assert sorted(schedule, key=key) == sorted(
+            calculate_cleaning_times(calendars), key=key
+        )
+        assert calculate_cleaning_times(
+            calendars, window, vectorized=True
+        ) == calculate_cleaning_times(calendars, window)
+
+
+def random_cleaning_buffers(count):
+    rng = random.Random(count)
+    first_day = datetime.date(2024, 1, 1).toordinal()
+
+    cleaning_buffers = []
+    for i in range(count):
+        start = first_day + rng.randint(0, 365 * 10)
+        end = start + rng.randint(0, 5)
+        cleaning_buffers.append(
+            CleaningBuffer(
+                calendar_id=i % 500,
+                start=datetime.date.fromordinal(start),
+                end=datetime.date.fromordinal(end),
+            )
+        )
+
+    return cleaning_buffers
+
+
+@pytest.mark.benchmark
+def test_find_cleaning_dates_scaling():
+    timings = {}
+    for count in (100_000, 1_000_000):
+        cleaning_buffers = random_cleaning_buffers(count)
+
+        started = time.perf_counter()
+        cleaning_dates = find_cleaning_dates(cleaning_buffers)
+        timings[count] = time.perf_counter() - started
+
+        assert len(cleaning_dates) == count
+
+    # 10x more buffers should cost roughly 10x (n log n), far from 100x of the old loop
+    assert timings[1_000_000] < 30 * timings[100_000]
+
+
+@pytest.mark.benchmark
+def test_vectorized_faster_for_many_calendars():
+    rng = random.Random(10_000)
+
+    # Plain objects instead of table models, so building the input doesn't dominate
+    calendars = []
+    for calendar_id in range(1, 10_001):
+        events = []
+        day = datetime.date(2024, 1, 1)
+        for _ in range(25):
+            start = day + datetime.timedelta(days=rng.randint(0, 4))
+            end = start + datetime.timedelta(days=rng.randint(1, 7))
+            events.append(SimpleNamespace(date_start=start, date_end=end))
+            day = end
+        calendars.append(SimpleNamespace(id=calendar_id, events=events))
+
+    started = time.perf_counter()
+    cleaning_dates = find_cleaning_dates(create_cleaning_buffers(calendars))
+    object_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    calendar_ids, starts, ends = create_cleaning_buffer_columns(calendars)
+    cleaning_order, dates = find_cleaning_dates_vectorized(starts, ends)
+    vectorized_time = time.perf_counter() - started
+
+    assert [
+        (buffer.calendar_id, cleaning_date) for buffer, cleaning_date in cleaning_dates
+    ] == list(
+        zip(calendar_ids[cleaning_order].tolist(), dates[cleaning_order].tolist())
+    )
+    assert vectorized_time < object_time
+
+
+@dataclass
+class DictBackedCleaningBuffer:
+    """
+    Cleaning buffer as it looked before it was slotted
+    """
+
+    calendar_id: int
+    start: datetime.date
+    end: datetime.date
+    cleaned: bool = False
+
+
+def retained_bytes_per_buffer(create_buffers):
+    calendars = [
+        SimpleNamespace(
+            id=calendar_id,
+            events=[
+                SimpleNamespace(
+                    date_start=datetime.date.fromordinal(738_000 + 3 * day),
+                    date_end=datetime.date.fromordinal(738_000 + 3 * day + 2),
+                )
+                for day in range(101)
+            ],
+        )
+        for calendar_id in range(1, 1_001)
+    ]
+
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        cleaning_buffers = create_buffers(calendars)
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # Buffers are still referenced here, so the difference is what they keep allocated
+    del cleaning_buffers
+    return (after - before) / 100_000
+
+
+def test_cleaning_buffer_memory():
+    dict_backed = retained_bytes_per_buffer(
+        lambda calendars: [
+            DictBackedCleaningBuffer(buffer.calendar_id, buffer.start, buffer.end)
+            for buffer in create_cleaning_buffers(calendars)
+        ]
+    )
+    slotted = retained_bytes_per_buffer(create_cleaning_buffers)
+    columns = retained_bytes_per_buffer(create_cleaning_buffer_columns)
+
+    # Roughly 112, 64 and 24 bytes per buffer
+    assert slotted < dict_backed
+    assert columns * 4 < dict_backed
+
+
+def test_cleaning_buffers_cached_by_content_hash():
+    buffer_cache.clear()
+    events = [
+        Event(
+            date_start=datetime.date(2024, 11, 1), date_end=datetime.date(2024, 11, 3)
+        ),
+        Event(
+            date_start=datetime.date(2024, 11, 5), date_end=datetime.date(2024, 11, 8)
+        ),
+    ]
+    calendar = SimpleNamespace(id=1, content_hash="hash", events=events)
+    buffers = create_cleaning_buffers([calendar])
+
+    # Same file, the events aren't looked at again
+    same_calendar = SimpleNamespace(id=1, content_hash="hash", events=[])
+    assert create_cleaning_buffers([same_calendar]) == buffers
+
+    changed_calendar = SimpleNamespace(id=1, content_hash="new hash", events=[])
+    assert create_cleaning_buffers([changed_calendar]) == []
+
+
+def test_schedule_memoized_by_content_hashes(monkeypatch):
+    schedule_cache.clear()
+    rng = random.Random(7)
+    calendars = random_calendars(rng, calendar_count=5, max_events=20)
+    for calendar in calendars:
+        calendar.content_hash = f"hash {calendar.id}"
+
+    cleaning_dates = calculate_cleaning_dates(calendars)
+
+    def find_cleaning_dates(*args):
+        raise AssertionError("Schedule should be memoized")
+
+    monkeypatch.setattr(cleaning_algorithm, "find_cleaning_dates", find_cleaning_dates)
+    assert calculate_cleaning_dates(calendars) == cleaning_dates
+
+    calendars[0].content_hash = "changed"
+    with pytest.raises(AssertionError):
+        calculate_cleaning_dates(calendars)
@@ -0,0 +1,44 @@
+import time
+
+from app.cache import LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_lru_cache_expires_entries(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+
+    cache = LRUCache(max_size=10, ttl_seconds=60)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl_seconds=10)
+
+    now += 30
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+
+    now += 31
+    assert cache.get("a") is None
+
+
+def test_lru_cache_discard_where():
+    cache = LRUCache(max_size=10)
+    cache.set("token_1", {"username": "ana"})
+    cache.set("token_2", {"username": "ana"})
+    cache.set("token_3", {"username": "ivo"})
+
+    cache.discard_where(lambda user: user["username"] == "ana")
+
+    assert len(cache) == 1
+    assert cache.get("token_3") == {"username": "ivo"}
@@ -0,0 +1,145 @@
+import datetime
+
+import httpx
+import pytest
+from sqlmodel import Session, SQLModel, create_engine, select
+from sqlmodel.pool import StaticPool
+
+from app import utils
+from app.calendar_sync import sync_calendars
+from app.models.calendars import Calendar, CleaningDate
+from app.models.users import User
+
+
+TEST_FILES_PATH = "app/tests/test_files"
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(name="session")
+def session_fixture():
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def read_test_file(name):
+    with open(f"{TEST_FILES_PATH}/valid/{name}.ics", "rb") as f:
+        return f.read()
+
+
+class CalendarFeeds:
+    """
+    Feeds served through a mock transport, answering conditional requests with 304
+    """
+
+    def __init__(self):
+        self.files: dict[str, bytes] = {}
+        self.requests: list[httpx.Request] = []
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+
+        file = self.files[request.url.path]
+        etag = f'"{utils.content_hash(file)}"'
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+
+        return httpx.Response(200, content=file, headers={"ETag": etag})
+
+
+@pytest.fixture(name="feeds")
+def feeds_fixture():
+    return CalendarFeeds()
+
+
+@pytest.fixture(name="http_client")
+async def http_client_fixture(feeds: CalendarFeeds):
+    async with httpx.AsyncClient(
+        transport=httpx.MockTransport(feeds.handle), base_url="http://feeds"
+    ) as http_client:
+        yield http_client
+
+
+def add_url_calendar(session: Session, user: User, path: str, file: bytes) -> Calendar:
+    calendar = utils.parse_calendar(file)
+    calendar.user = user
+    calendar.url = f"http://feeds{path}"
+    session.add(calendar)
+    session.commit()
+    return calendar
+
+
+@pytest.mark.anyio
+async def test_sync_skips_unchanged_feeds(
+    session: Session, feeds: CalendarFeeds, http_client: httpx.AsyncClient
+):
+    user = User(username="owner", hashed_password="")
+    feeds.files["/1.ics"] = read_test_file("apartment_1")
+    feeds.files["/2.ics"] = read_test_file("apartment_2")
+    add_url_calendar(session, user, "/1.ics", feeds.files["/1.ics"])
+    add_url_calendar(session, user, "/2.ics", feeds.files["/2.ics"])
+
+    # First sync only learns the ETags, content is the same as imported
+    assert await sync_calendars(session, http_client) == set()
+    assert [request.headers.get("If-None-Match") for request in feeds.requests] == [
+        None,
+        None,
+    ]
+
+    feeds.requests.clear()
+    assert await sync_calendars(session, http_client) == set()
+    assert all(request.headers.get("If-None-Match") for request in feeds.requests)
+
+
+@pytest.mark.anyio
+async def test_sync_updates_changed_feeds(
+    session: Session, feeds: CalendarFeeds, http_client: httpx.AsyncClient
+):
+    owner = User(username="owner", hashed_password="")
+    other = User(username="other", hashed_password="")
+    feeds.files["/1.ics"] = read_test_file("apartment_1")
+    feeds.files["/4.ics"] = read_test_file("apartment_4")
+    changing = add_url_calendar(session, owner, "/1.ics", feeds.files["/1.ics"])
+    add_url_calendar(session, other, "/4.ics", feeds.files["/4.ics"])
+
+    # Bookings on the feed change
+    feeds.files["/1.ics"] = read_test_file("apartment_2")
+
+    assert await sync_calendars(session, http_client) == {"owner"}
+
+    session.refresh(changing)
+    assert changing.content_hash == utils.content_hash(read_test_file("apartment_2"))
+    assert [(event.date_start, event.date_end) for event in changing.events] == [
+        (datetime.date(2020, 9, 30), datetime.date(2020, 10, 3)),
+        (datetime.date(2020, 10, 5), datetime.date(2020, 10, 10)),
+    ]
+    assert [
+        cleaning_date.date for cleaning_date in session.exec(select(CleaningDate))
+    ] == [datetime.date(2020, 10, 5)]
+
+
+@pytest.mark.anyio
+async def test_sync_keeps_validators_on_bare_304(session: Session):
+    user = User(username="owner", hashed_password="")
+    calendar = add_url_calendar(session, user, "/1.ics", read_test_file("apartment_1"))
+    calendar.etag = '"v1"'
+    calendar.last_modified = "Wed, 21 Oct 2020 07:28:00 GMT"
+    session.commit()
+
+    # Servers don't have to repeat the validators in a 304
+    def handle(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(304)
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handle)) as http_client:
+        assert await sync_calendars(session, http_client) == set()
+
+    session.refresh(calendar)
+    assert calendar.etag == '"v1"'
+    assert calendar.last_modified == "Wed, 21 Oct 2020 07:28:00 GMT"
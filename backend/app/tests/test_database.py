@@ -0,0 +1,156 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import inspect, text
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from app import utils
+from app.database import (
+    add_missing_columns,
+    add_missing_indexes,
+    create_db_engine,
+    move_calendar_content,
+)
+from app.models.calendars import Calendar, CalendarFile, CleaningDate, Event
+from app.models.users import User
+
+
+def test_add_missing_columns(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/database.db")
+    with engine.begin() as connection:
+        # Calendar table as it was created before syncing was added
+        connection.execute(
+            text(
+                "CREATE TABLE calendar (name VARCHAR, id INTEGER PRIMARY KEY, "
+                "url VARCHAR, user_id VARCHAR, content BLOB)"
+            )
+        )
+        connection.execute(text("INSERT INTO calendar (name) VALUES ('old')"))
+
+    add_missing_columns(engine)
+
+    columns = {column["name"] for column in inspect(engine).get_columns("calendar")}
+    assert {"content_hash", "etag", "last_modified"} <= columns
+
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT name, etag FROM calendar")).all() == [
+            ("old", None)
+        ]
+
+
+def test_move_calendar_content(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/database.db")
+    with engine.begin() as connection:
+        # Calendar table as it was when files were stored in it
+        connection.execute(
+            text(
+                "CREATE TABLE calendar (name VARCHAR, id INTEGER PRIMARY KEY, "
+                "url VARCHAR, user_id VARCHAR, content BLOB)"
+            )
+        )
+        connection.execute(
+            text("INSERT INTO calendar (name, content) VALUES ('old', :content)"),
+            {"content": b"BEGIN:VCALENDAR"},
+        )
+        connection.execute(text("INSERT INTO calendar (name) VALUES ('empty')"))
+
+    add_missing_columns(engine)
+    SQLModel.metadata.create_all(engine)
+    move_calendar_content(engine)
+
+    with engine.connect() as connection:
+        assert connection.execute(
+            text("SELECT name, content, content_hash FROM calendar")
+        ).all() == [
+            ("old", None, utils.content_hash(b"BEGIN:VCALENDAR")),
+            ("empty", None, None),
+        ]
+
+    with Session(engine) as session:
+        calendar_file = session.exec(select(CalendarFile)).one()
+        assert calendar_file.size == len(b"BEGIN:VCALENDAR")
+        assert (
+            b"".join(utils.iter_decompressed(calendar_file.data)) == b"BEGIN:VCALENDAR"
+        )
+
+
+def test_add_missing_indexes(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/database.db")
+    with engine.begin() as connection:
+        # Event table as it was created before indexes were added
+        connection.execute(
+            text(
+                "CREATE TABLE event (id INTEGER PRIMARY KEY, uid VARCHAR, "
+                "summary VARCHAR, date_start DATE, date_end DATE, calendar_id INTEGER)"
+            )
+        )
+
+    add_missing_indexes(engine)
+    # Running it again on an up to date database does nothing
+    add_missing_indexes(engine)
+
+    assert [index["name"] for index in inspect(engine).get_indexes("event")] == [
+        "ix_event_calendar_id_date_start_date_end"
+    ]
+
+
+def test_sqlite_engine_settings(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path}/database.db")
+
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        # 1 is NORMAL
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+
+
+def test_in_memory_engine_shares_database():
+    engine = create_db_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+
+    with Session(engine) as session:
+        session.add(User(username="owner", hashed_password=""))
+        session.commit()
+
+    # Another thread gets the same connection, a new one would be an empty database
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(lambda: Session(engine).get(User, "owner"))
+        assert future.result() is not None
+
+
+def test_concurrent_writes(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path}/database.db")
+    SQLModel.metadata.create_all(engine)
+
+    with Session(engine) as session:
+        session.add(User(username="owner", hashed_password=""))
+        calendar = Calendar(name="apartment", user_id="owner")
+        session.add(calendar)
+        session.commit()
+        calendar_id = calendar.id
+
+    def write_cleaning_dates(worker: int):
+        for i in range(25):
+            with Session(engine) as session:
+                # Read first, like the routes do, then write
+                assert session.get(Calendar, calendar_id) is not None
+                date = datetime.date(2024, 1, 1) + datetime.timedelta(days=i)
+                session.add(CleaningDate(calendar_id=calendar_id, date=date))
+                session.add(
+                    Event(
+                        calendar_id=calendar_id,
+                        uid=f"{worker}-{i}",
+                        summary="Reserved",
+                        date_start=date,
+                        date_end=date + datetime.timedelta(days=1),
+                    )
+                )
+                session.commit()
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        # Re-raises "database is locked" errors, if there are any
+        list(executor.map(write_cleaning_dates, range(16)))
+
+    with Session(engine) as session:
+        assert len(session.exec(select(CleaningDate)).all()) == 16 * 25
+        assert len(session.exec(select(Event)).all()) == 16 * 25
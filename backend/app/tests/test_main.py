@@ -1,16 +1,73 @@
 import pytest
+import anyio
 import hashlib
 import datetime
-
-from fastapi import status
+import httpx
+import icalendar
+import json
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from fastapi import FastAPI, HTTPException, status
+from passlib.context import CryptContext
+from sqlalchemy import Engine, event
 from fastapi.testclient import TestClient
-from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel import Session, SQLModel, col, create_engine, insert, select
 from sqlmodel.pool import StaticPool
 
 from app.main import app
-from app.database import get_session
+from app import cleaning_algorithm
+from app.cleaning_algorithm import calculate_cleaning_times
+from app.crud import (
+    recalculate_cleaning_dates,
+    store_calendar_file,
+    update_calendar_content,
+)
+from app.config import settings
+from app.database import create_db_engine, get_session
+from app.deps import CurrentUser, SessionDep
+from app.http_client import create_http_client, get_http_client
+from app.models.calendars import (
+    Calendar,
+    CalendarFile,
+    CalendarPublic,
+    CleaningDate,
+    Event,
+)
+from app.routes import calendars
 from app.models.users import User, UserCreate
-from app.security import get_password_hash, create_access_token
+from app import deps, parse_pool, recalculation, security, utils
+from app.security import get_password_hash, create_access_token, verify_password
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(autouse=True)
+def recalculate_inline():
+    """
+    Cleaning dates are recalculated before import responses, so tests can check them
+    """
+    # Not with monkeypatch, which would then be undone after the other fixtures
+    backend = recalculation.recalculation_queue.backend
+    recalculation.recalculation_queue.backend = recalculation.InlineJobBackend()
+    yield
+    recalculation.recalculation_queue.backend = backend
+
+
+@pytest.fixture
+def started_parse_pool():
+    """
+    Parse pool started like on app startup, and closed again after the test
+    """
+    parse_pool.start_parse_pool()
+    yield
+    parse_pool.close_parse_pool()
 
 
 @pytest.fixture(name="session")
@@ -28,10 +85,17 @@ def client_fixture(session: Session):
     def get_session_override():
         return session
 
+    async def get_http_client_override():
+        # Every test client request runs in its own event loop, the pool can't be shared
+        async with create_http_client() as http_client:
+            yield http_client
+
     app.dependency_overrides[get_session] = get_session_override
+    app.dependency_overrides[get_http_client] = get_http_client_override
     client = TestClient(app)
     yield client
     app.dependency_overrides.clear()
+    deps.authenticated_users.clear()
 
 
 @pytest.fixture(name="user")
@@ -78,6 +142,34 @@ def logged_in_user_fixture(session: Session):
 TEST_FILES_PATH = "app/tests/test_files"
 
 
+class CalendarFeedHandler(SimpleHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/slow/"):
+            time.sleep(0.5)
+            self.path = self.path.removeprefix("/slow")
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(name="feed_url")
+def feed_server_fixture():
+    """
+    Local HTTP server serving the test calendar files
+    """
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(CalendarFeedHandler, directory=TEST_FILES_PATH)
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{server.server_port}"
+
+    server.shutdown()
+    server.server_close()
+
+
 def test_get_token_not_auth(client: TestClient):
     response = client.post("/token")
 
@@ -92,6 +184,80 @@ def test_get_token(client: TestClient, user: UserCreate):
     assert "access_token" in response.json()
 
 
+def test_login_rehashes_password_with_new_cost(client: TestClient, session: Session):
+    old_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4)
+    user = User(username="old_user", hashed_password=old_context.hash("pass1234"))
+    session.add(user)
+    session.commit()
+
+    response = client.post(
+        "/token", data={"username": "old_user", "password": "pass1234"}
+    )
+    assert response.status_code == status.HTTP_200_OK
+
+    session.refresh(user)
+    assert user.hashed_password.startswith(f"$2b${settings.BCRYPT_ROUNDS}$")
+    assert verify_password("pass1234", user.hashed_password)
+
+
+def test_login_when_password_workers_busy(
+    client: TestClient, user: UserCreate, monkeypatch
+):
+    monkeypatch.setattr(security, "password_slots", threading.BoundedSemaphore(1))
+    security.password_slots.acquire()
+
+    login_payload = {"username": user.username, "password": user.password}
+    response = client.post("/token", data=login_payload)
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+
+    security.password_slots.release()
+    response = client.post("/token", data=login_payload)
+    assert response.status_code == status.HTTP_200_OK
+
+
+@pytest.mark.anyio
+async def test_logins_dont_block_other_requests(
+    client: TestClient, auth_headers: dict, monkeypatch
+):
+    finished = []
+    # Logins can't finish until the other request did
+    release_logins = threading.Event()
+    real_pwd_context = security.pwd_context
+
+    class BlockedPasswordContext:
+        def verify_and_update(self, *args):
+            release_logins.wait(timeout=10)
+            return real_pwd_context.verify_and_update(*args)
+
+    monkeypatch.setattr(security, "pwd_context", BlockedPasswordContext())
+
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://test"
+    ) as async_client:
+
+        async def login():
+            response = await async_client.post(
+                "/token", data={"username": "test_user", "password": "pass1234"}
+            )
+            assert response.status_code == status.HTTP_200_OK
+            finished.append("login")
+
+        async def get_calendars():
+            try:
+                response = await async_client.get("/calendars/", headers=auth_headers)
+                assert response.status_code == status.HTTP_200_OK
+                finished.append("get")
+            finally:
+                release_logins.set()
+
+        async with anyio.create_task_group() as task_group:
+            for _ in range(settings.PASSWORD_HASH_WORKERS * 2):
+                task_group.start_soon(login)
+            task_group.start_soon(get_calendars)
+
+    assert finished[0] == "get"
+
+
 def test_get_calendars_not_auth(client: TestClient):
     response = client.get("/calendars")
 
@@ -106,6 +272,219 @@ def test_get_calendars(client: TestClient, auth_headers: dict):
     assert response.status_code == status.HTTP_200_OK
 
 
+def upload_test_calendars(client: TestClient, auth_headers: dict, apartments):
+    for apartment in apartments:
+        with open(f"{TEST_FILES_PATH}/valid/{apartment}.ics", "rb") as f:
+            response = client.post(
+                "/import-calendar",
+                headers=auth_headers,
+                files={"file": f},
+            )
+        assert response.status_code == status.HTTP_200_OK
+
+
+def executed_statements(session: Session, request):
+    """
+    Run `request` and return the kinds (SELECT, INSERT, ...) of SQL statements it ran
+    """
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split()[0])
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", record_statement)
+    try:
+        response = request()
+    finally:
+        event.remove(engine, "before_cursor_execute", record_statement)
+
+    assert response.status_code == status.HTTP_200_OK
+    return statements, response
+
+
+def count_selects(session: Session, request):
+    statements, response = executed_statements(session, request)
+    return statements.count("SELECT"), response.json()
+
+
+def test_get_calendars_constant_queries(
+    client: TestClient, auth_headers: dict, session: Session
+):
+    upload_test_calendars(client, auth_headers, ["apartment_1"])
+    selects_one, _ = count_selects(
+        session, lambda: client.get("/calendars", headers=auth_headers)
+    )
+
+    upload_test_calendars(
+        client, auth_headers, ["apartment_2", "apartment_3", "apartment_4"]
+    )
+    selects_four, data = count_selects(
+        session, lambda: client.get("/calendars", headers=auth_headers)
+    )
+
+    assert selects_one == selects_four
+    assert [len(calendar["events"]) for calendar in data] == [2, 2, 2, 3]
+    assert [len(calendar["cleaning_dates"]) for calendar in data] == [1, 1, 1, 2]
+
+
+def test_get_calendars_date_filter(
+    client: TestClient, auth_headers: dict, session: Session
+):
+    upload_test_calendars(
+        client, auth_headers, ["apartment_1", "apartment_3", "apartment_4"]
+    )
+
+    selects, data = count_selects(
+        session,
+        lambda: client.get(
+            "/calendars",
+            headers=auth_headers,
+            params={"from_date": "2024-11-04", "to_date": "2024-11-09"},
+        ),
+    )
+
+    assert selects <= 3
+    assert [
+        [(event["date_start"], event["date_end"]) for event in calendar["events"]]
+        for calendar in data
+    ] == [
+        [],
+        [("2024-11-01", "2024-11-05"), ("2024-11-05", "2024-11-15")],
+        [("2024-11-02", "2024-11-05"), ("2024-11-09", "2024-11-12")],
+    ]
+
+
+def test_get_calendars_pages(client: TestClient, auth_headers: dict):
+    upload_test_calendars(
+        client,
+        auth_headers,
+        ["apartment_1", "apartment_2", "apartment_3", "apartment_4"],
+    )
+    all_calendars = client.get("/calendars/", headers=auth_headers).json()
+
+    pages = []
+    params: dict[str, int | str] = {"limit": 3}
+    while True:
+        response = client.get("/calendars/", headers=auth_headers, params=params)
+        assert response.status_code == status.HTTP_200_OK
+        pages.append(response.json())
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+
+    assert [len(page) for page in pages] == [3, 1]
+    assert [calendar for page in pages for calendar in page] == all_calendars
+
+    # Readable by the frontend, which isn't on the API's origin
+    response = client.get(
+        "/calendars/",
+        headers={**auth_headers, "Origin": "http://localhost:3000"},
+        params={"limit": 1},
+    )
+    exposed = response.headers["Access-Control-Expose-Headers"].split(",")
+    assert "X-Next-Cursor" in [header.strip() for header in exposed]
+
+    response = client.get(
+        "/calendars/", headers=auth_headers, params={"cursor": "not a cursor"}
+    )
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_get_calendars_without_events(
+    client: TestClient, auth_headers: dict, session: Session
+):
+    upload_test_calendars(client, auth_headers, ["apartment_1", "apartment_4"])
+    all_selects, _ = count_selects(
+        session, lambda: client.get("/calendars/", headers=auth_headers)
+    )
+
+    selects, data = count_selects(
+        session,
+        lambda: client.get(
+            "/calendars/",
+            headers=auth_headers,
+            params={"include_events": False, "include_cleaning_dates": False},
+        ),
+    )
+    assert selects == all_selects - 2
+    assert [(calendar["events"], calendar["cleaning_dates"]) for calendar in data] == [
+        (None, None),
+        (None, None),
+    ]
+
+    data = client.get(
+        "/calendars/", headers=auth_headers, params={"include_events": False}
+    ).json()
+    assert [len(calendar["cleaning_dates"]) for calendar in data] == [1, 2]
+
+
+def test_get_calendars_stream(client: TestClient, auth_headers: dict, monkeypatch):
+    upload_test_calendars(
+        client,
+        auth_headers,
+        ["apartment_1", "apartment_2", "apartment_3", "apartment_4"],
+    )
+    all_calendars = client.get("/calendars/", headers=auth_headers).json()
+    monkeypatch.setattr(settings, "CALENDARS_STREAM_BATCH_SIZE", 3)
+
+    response = client.get(
+        "/calendars/", headers={**auth_headers, "Accept": "application/x-ndjson"}
+    )
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.iter_lines()] == all_calendars
+
+    # Streams from the cursor on
+    cursor = client.get(
+        "/calendars/", headers=auth_headers, params={"limit": 1}
+    ).headers["X-Next-Cursor"]
+    response = client.get(
+        "/calendars/",
+        headers={**auth_headers, "Accept": "application/x-ndjson"},
+        params={"cursor": cursor},
+    )
+    assert [json.loads(line) for line in response.iter_lines()] == all_calendars[1:]
+
+
+def test_calendar_queries_use_indexes(
+    client: TestClient, auth_headers: dict, session: Session
+):
+    upload_test_calendars(client, auth_headers, ["apartment_1", "apartment_3"])
+
+    queries = []
+
+    def record_query(conn, cursor, statement, parameters, context, executemany):
+        tables = ("FROM event", "FROM cleaningdate")
+        if statement.startswith("SELECT") and any(
+            table in statement for table in tables
+        ):
+            queries.append((statement, parameters))
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", record_query)
+    try:
+        client.get("/calendars", headers=auth_headers)
+        client.get(
+            "/calendars",
+            headers=auth_headers,
+            params={"from_date": "2024-11-04", "to_date": "2024-11-09"},
+        )
+    finally:
+        event.remove(engine, "before_cursor_execute", record_query)
+
+    assert queries
+    connection = session.connection()
+    for statement, parameters in queries:
+        plan = " ".join(
+            row[-1]
+            for row in connection.exec_driver_sql(
+                f"EXPLAIN QUERY PLAN {statement}", parameters
+            )
+        )
+        assert "USING INDEX ix_" in plan or "USING COVERING INDEX ix_" in plan, plan
+        assert "SCAN event" not in plan and "SCAN cleaningdate" not in plan, plan
+
+
 def test_upload_calendar_not_auth(client: TestClient):
     with open(f"{TEST_FILES_PATH}/valid/apartment_1.ics", "rb") as f:
         response = client.post(
@@ -167,6 +546,7 @@ def test_upload_calendar_invalid(client: TestClient, auth_headers: dict):
         "events_conflict.ics",
         "events_same_end.ics",
         "events_same_start.ics",
+        "impossible_date.ics",
         "malformed.ics",
         "no_begin.ics",
         "no_begin_event.ics",
@@ -186,6 +566,31 @@ def test_upload_calendar_invalid(client: TestClient, auth_headers: dict):
         assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
 
 
+def test_upload_calendar_reports_event_errors(client: TestClient, auth_headers: dict):
+    with open(f"{TEST_FILES_PATH}/invalid/events_conflict.ics", "rb") as f:
+        response = client.post(
+            "/import-calendar",
+            headers=auth_headers,
+            files={"file": f},
+        )
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert response.json()["detail"] == {
+        "message": "Events not valid",
+        "errors": [
+            {
+                "reason": "Events overlap",
+                "uid": "aca171cfaa8cf1c5765e64e819906485",
+                "date_start": "2020-09-30",
+                "date_end": "2020-10-02",
+                "other_uid": "26db1820702b397cc969489412b44f6a",
+                "other_date_start": "2020-10-01",
+                "other_date_end": "2020-10-10",
+            }
+        ],
+    }
+
+
 def test_upload_and_download(client: TestClient, auth_headers: dict):
     with open(f"{TEST_FILES_PATH}/valid/apartment_1.ics", "rb") as f:
         original_file_checksum = hashlib.md5(f.read()).hexdigest()
@@ -205,6 +610,532 @@ def test_upload_and_download(client: TestClient, auth_headers: dict):
     assert original_file_checksum == received_file_checksum
 
 
+def test_calendar_file_stored_compressed(
+    client: TestClient, auth_headers: dict, session: Session, big_calendar
+):
+    file = big_calendar(2_000)
+    response = client.post(
+        "/import-calendar", headers=auth_headers, files={"file": ("big.ics", file)}
+    )
+    assert response.status_code == status.HTTP_200_OK
+
+    calendar_file = session.exec(
+        select(CalendarFile).where(
+            CalendarFile.content_hash == utils.content_hash(file)
+        )
+    ).one()
+    assert calendar_file.size == len(file)
+    assert len(calendar_file.data) < len(file) / 5
+
+    # Calendars are loaded without their files
+    statements = []
+
+    def record_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(session.get_bind(), "before_cursor_execute", record_statement)
+    try:
+        response = client.get("/calendars/", headers=auth_headers)
+        assert response.status_code == status.HTTP_200_OK
+    finally:
+        event.remove(session.get_bind(), "before_cursor_execute", record_statement)
+    assert not any("calendarfile" in statement for statement in statements)
+
+    response = client.get(
+        f"/calendars/{response.json()[0]['id']}",
+        headers={**auth_headers, "Accept-Encoding": "identity"},
+    )
+    assert response.headers["Content-Length"] == str(len(file))
+    assert response.read() == file
+
+
+def upload_apartment_1(client: TestClient, auth_headers: dict) -> tuple[int, bytes]:
+    with open(f"{TEST_FILES_PATH}/valid/apartment_1.ics", "rb") as f:
+        file = f.read()
+    response = client.post(
+        "/import-calendar", headers=auth_headers, files={"file": ("a.ics", file)}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    return response.json()["id"], file
+
+
+def test_download_not_modified(
+    client: TestClient, auth_headers: dict, session: Session
+):
+    calendar_id, file = upload_apartment_1(client, auth_headers)
+    headers = {**auth_headers, "Accept-Encoding": "identity"}
+
+    response = client.get(f"/calendars/{calendar_id}", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["ETag"] == f'"{utils.content_hash(file)}"'
+    etag, last_modified = response.headers["ETag"], response.headers["Last-Modified"]
+
+    statements = []
+
+    def record_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(session.get_bind(), "before_cursor_execute", record_statement)
+    try:
+        response = client.get(
+            f"/calendars/{calendar_id}", headers={**headers, "If-None-Match": etag}
+        )
+    finally:
+        event.remove(session.get_bind(), "before_cursor_execute", record_statement)
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.content == b""
+    assert not any("calendarfile" in statement for statement in statements)
+
+    response = client.get(
+        f"/calendars/{calendar_id}", headers={**headers, "If-None-Match": '"other"'}
+    )
+    assert response.status_code == status.HTTP_200_OK
+
+    response = client.get(
+        f"/calendars/{calendar_id}",
+        headers={**headers, "If-Modified-Since": last_modified},
+    )
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    response = client.get(
+        f"/calendars/{calendar_id}",
+        headers={**headers, "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.read() == file
+
+
+def test_download_gzip(client: TestClient, auth_headers: dict):
+    calendar_id, file = upload_apartment_1(client, auth_headers)
+
+    response = client.get(
+        f"/calendars/{calendar_id}",
+        headers={**auth_headers, "Accept-Encoding": "gzip"},
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["ETag"] == f'"{utils.content_hash(file)}-gzip"'
+    # Decompressed by the client
+    assert response.read() == file
+
+    response = client.get(
+        f"/calendars/{calendar_id}",
+        headers={**auth_headers, "Accept-Encoding": "gzip;q=0, deflate"},
+    )
+    assert "Content-Encoding" not in response.headers
+    assert response.read() == file
+
+    # Explicit gzip entry wins over *, in either order
+    for accept_encoding in ("*;q=0, gzip", "gzip, *;q=0"):
+        response = client.get(
+            f"/calendars/{calendar_id}",
+            headers={**auth_headers, "Accept-Encoding": accept_encoding},
+        )
+        assert response.headers["Content-Encoding"] == "gzip"
+
+    response = client.get(
+        f"/calendars/{calendar_id}",
+        headers={**auth_headers, "Accept-Encoding": "gzip;q=0, *"},
+    )
+    assert "Content-Encoding" not in response.headers
+
+
+def test_download_range(client: TestClient, auth_headers: dict):
+    calendar_id, file = upload_apartment_1(client, auth_headers)
+
+    def get_range(range_header: str, **headers):
+        return client.get(
+            f"/calendars/{calendar_id}",
+            headers={**auth_headers, "Range": range_header, **headers},
+        )
+
+    response = get_range("bytes=10-19")
+    assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+    assert response.headers["Content-Range"] == f"bytes 10-19/{len(file)}"
+    assert response.read() == file[10:20]
+
+    response = get_range("bytes=-15")
+    assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+    assert response.read() == file[-15:]
+
+    response = get_range(f"bytes={len(file)}-")
+    assert response.status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+    assert response.headers["Content-Range"] == f"bytes */{len(file)}"
+
+    # Invalid ranges are ignored
+    for range_header in ("bytes=19-10", "bytes=a-b", "bytes=-"):
+        response = get_range(range_header)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.read() == file
+
+    # File changed since the client got the first part
+    response = get_range("bytes=10-19", **{"If-Range": '"old"'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.read() == file
+
+
+def test_cleaning_schedule_feed(
+    client: TestClient, auth_headers: dict, session: Session, monkeypatch
+):
+    upload_test_calendars(client, auth_headers, ["apartment_1", "apartment_3"])
+    calendars_data = client.get("/calendars/", headers=auth_headers).json()
+    calendars.cleaning_schedule_feeds.clear()
+
+    response = client.get("/cleaning-schedule/", headers=auth_headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["Content-Type"].startswith("text/calendar")
+
+    feed = icalendar.Calendar.from_ical(response.text)
+    names = {calendar["id"]: calendar["name"] for calendar in calendars_data}
+    assert sorted(
+        (event["DTSTART"].dt, str(event["SUMMARY"])) for event in feed.walk("VEVENT")
+    ) == sorted(
+        (
+            datetime.date.fromisoformat(cleaning_date["date"]),
+            f"Cleaning: {names[calendar['id']]}",
+        )
+        for calendar in calendars_data
+        for cleaning_date in calendar["cleaning_dates"]
+    )
+
+    def create_cleaning_schedule(*args):
+        raise AssertionError("Feed should be cached")
+
+    etag = response.headers["ETag"]
+    with monkeypatch.context() as patch:
+        patch.setattr(utils, "create_cleaning_schedule", create_cleaning_schedule)
+        statements, response = executed_statements(
+            session, lambda: client.get("/cleaning-schedule/", headers=auth_headers)
+        )
+        assert response.headers["ETag"] == etag
+        # Cached feed is found without reading the cleaning dates
+        assert statements == ["SELECT"]
+        response = client.get(
+            "/cleaning-schedule/", headers={**auth_headers, "If-None-Match": etag}
+        )
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    # New calendar changes the cleaning dates, so the feed is generated again
+    upload_test_calendars(client, auth_headers, ["apartment_4"])
+    response = client.get(
+        "/cleaning-schedule/", headers={**auth_headers, "If-None-Match": etag}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["ETag"] != etag
+
+    calendar_id = calendars_data[0]["id"]
+    response = client.get(
+        f"/calendars/{calendar_id}/cleaning-schedule/", headers=auth_headers
+    )
+    feed = icalendar.Calendar.from_ical(response.text)
+    assert {str(event["SUMMARY"]) for event in feed.walk("VEVENT")} == {
+        f"Cleaning: {names[calendar_id]}"
+    }
+
+
+def test_cleaning_schedule_feed_by_token(client: TestClient, auth_headers: dict):
+    upload_test_calendars(client, auth_headers, ["apartment_1", "apartment_3"])
+    calendar_id = client.get("/calendars/", headers=auth_headers).json()[0]["id"]
+
+    response = client.post("/feed-token", headers=auth_headers)
+    assert response.status_code == status.HTTP_200_OK
+    feed_token = response.json()["feed_token"]
+
+    # Calendar apps subscribe without an Authorization header
+    response = client.get(f"/feeds/{feed_token}/cleaning-schedule/")
+    assert response.status_code == status.HTTP_200_OK
+    assert (
+        response.content
+        == client.get("/cleaning-schedule/", headers=auth_headers).content
+    )
+    response = client.get(
+        f"/feeds/{feed_token}/calendars/{calendar_id}/cleaning-schedule/"
+    )
+    assert response.status_code == status.HTTP_200_OK
+
+    # New token revokes the old one
+    response = client.post("/feed-token", headers=auth_headers)
+    new_feed_token = response.json()["feed_token"]
+    response = client.get(f"/feeds/{feed_token}/cleaning-schedule/")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    response = client.get(f"/feeds/{new_feed_token}/cleaning-schedule/")
+    assert response.status_code == status.HTTP_200_OK
+
+    response = client.delete("/feed-token", headers=auth_headers)
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    response = client.get(f"/feeds/{new_feed_token}/cleaning-schedule/")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_upload_recalculates_cleaning_dates(
+    client: TestClient, auth_headers: dict, session: Session
+):
+    for apartment in ("apartment_1", "apartment_3", "apartment_2", "apartment_4"):
+        with open(f"{TEST_FILES_PATH}/valid/{apartment}.ics", "rb") as f:
+            response = client.post(
+                "/import-calendar",
+                headers=auth_headers,
+                files={"file": f},
+            )
+        assert response.status_code == status.HTTP_200_OK
+
+    def key(cleaning_date):
+        return (cleaning_date.date, cleaning_date.calendar_id)
+
+    stored = session.exec(select(CleaningDate)).all()
+    expected = calculate_cleaning_times(session.exec(select(Calendar)).all())
+
+    assert len(stored) == 5
+    assert sorted(map(key, stored)) == sorted(map(key, expected))
+
+
+def test_recalculation_reuses_cached_buffers(
+    client: TestClient, auth_headers: dict, session: Session, monkeypatch
+):
+    upload_test_calendars(client, auth_headers, ["apartment_1", "apartment_3"])
+    user = session.get(User, "test_user")
+    cleaning_algorithm.buffer_cache.clear()
+    cleaning_algorithm.schedule_cache.clear()
+
+    def recalculate():
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        session.expire_all()
+        event.listen(session.get_bind(), "before_cursor_execute", record_statement)
+        try:
+            recalculate_cleaning_dates(session, user)
+        finally:
+            event.remove(session.get_bind(), "before_cursor_execute", record_statement)
+        return statements
+
+    assert any("FROM event" in statement for statement in recalculate())
+    stored = session.exec(
+        select(col(CleaningDate.calendar_id), col(CleaningDate.date))
+    ).all()
+
+    def find_cleaning_dates(*args):
+        raise AssertionError("Schedule should be memoized")
+
+    monkeypatch.setattr(cleaning_algorithm, "find_cleaning_dates", find_cleaning_dates)
+    assert not any("FROM event" in statement for statement in recalculate())
+
+    assert (
+        session.exec(
+            select(col(CleaningDate.calendar_id), col(CleaningDate.date))
+        ).all()
+        == stored
+    )
+
+
+def calendar_file(events) -> bytes:
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID: upserted"]
+    for uid, summary, date_start, date_end in events:
+        lines += [
+            "BEGIN:VEVENT",
+            f"DTSTART;VALUE=DATE:{date_start:%Y%m%d}",
+            f"DTEND;VALUE=DATE:{date_end:%Y%m%d}",
+            f"UID:{uid}",
+            f"SUMMARY:{summary}",
+            "END:VEVENT",
+        ]
+    lines.append("END:VCALENDAR")
+
+    return "\r\n".join(lines).encode("utf-8")
+
+
+def upload(client: TestClient, auth_headers: dict, file: bytes, upsert: bool):
+    return client.post(
+        "/import-calendar",
+        headers=auth_headers,
+        params={"upsert": upsert},
+        files={"file": ("calendar.ics", file)},
+    )
+
+
+def test_upload_upsert_unchanged(
+    client: TestClient, auth_headers: dict, session: Session
+):
+    with open(f"{TEST_FILES_PATH}/valid/apartment_1.ics", "rb") as f:
+        file = f.read()
+
+    first = upload(client, auth_headers, file, upsert=True)
+    statements, second = executed_statements(
+        session, lambda: upload(client, auth_headers, file, upsert=True)
+    )
+
+    assert second.json()["id"] == first.json()["id"]
+    assert set(statements) == {"SELECT"}
+
+    upload(client, auth_headers, file, upsert=False)
+    assert len(session.exec(select(Calendar)).all()) == 2
+
+
+def test_upload_upsert_diffs_events_by_uid(
+    client: TestClient, auth_headers: dict, session: Session
+):
+    day = datetime.date(2024, 11, 1)
+    events = [
+        (
+            f"uid-{i}",
+            f"Guest {i}",
+            day + datetime.timedelta(days=3 * i),
+            day + datetime.timedelta(days=3 * i + 2),
+        )
+        for i in range(10)
+    ]
+    response = upload(client, auth_headers, calendar_file(events), upsert=True)
+    calendar_id = response.json()["id"]
+    event_ids = {event.uid: event.id for event in session.exec(select(Event))}
+
+    changed_events = [
+        *events[:3],
+        ("uid-3", "Renamed guest", events[3][2], events[3][3]),
+        *events[5:],
+        (
+            "uid-10",
+            "New guest",
+            events[9][3],
+            events[9][3] + datetime.timedelta(days=2),
+        ),
+    ]
+    response = upload(client, auth_headers, calendar_file(changed_events), upsert=True)
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["id"] == calendar_id
+
+    session.expire_all()
+    stored_events = session.exec(select(Event).order_by(col(Event.date_start))).all()
+    assert [
+        (event.uid, event.summary, event.date_start, event.date_end)
+        for event in stored_events
+    ] == changed_events
+    # Events that stayed are updated in place
+    assert all(
+        event.id == event_ids[event.uid]
+        for event in stored_events
+        if event.uid != "uid-10"
+    )
+
+    calendar = session.exec(select(Calendar).where(Calendar.id == calendar_id)).one()
+    stored = session.exec(
+        select(col(CleaningDate.calendar_id), col(CleaningDate.date))
+    ).all()
+    expected = calculate_cleaning_times([calendar])
+    assert sorted(stored) == sorted(
+        (cleaning_date.calendar_id, cleaning_date.date) for cleaning_date in expected
+    )
+
+
+class DeferredJobBackend:
+    """
+    Keeps jobs until the test runs them
+    """
+
+    delays_jobs = False
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, function, delay_seconds: float):
+        self.jobs.append(function)
+
+    def shutdown(self):
+        pass
+
+    def run_jobs(self):
+        while self.jobs:
+            self.jobs.pop(0)()
+
+
+def test_replaced_calendar_file_deleted_when_unused(
+    client: TestClient, auth_headers: dict, session: Session
+):
+    events = [
+        ("uid-1", "Guest", datetime.date(2024, 11, 1), datetime.date(2024, 11, 3))
+    ]
+    old_file = calendar_file(events)
+    new_file = calendar_file(
+        [
+            *events,
+            ("uid-2", "Guest", datetime.date(2024, 11, 5), datetime.date(2024, 11, 7)),
+        ]
+    )
+    for _ in range(2):
+        assert upload(client, auth_headers, old_file, upsert=False).status_code == 200
+
+    # Second calendar still has the old file
+    assert upload(client, auth_headers, new_file, upsert=True).status_code == 200
+    session.expire_all()
+    assert session.get(CalendarFile, utils.content_hash(old_file)) is not None
+
+    other_calendar = session.exec(
+        select(Calendar).where(Calendar.content_hash == utils.content_hash(old_file))
+    ).one()
+    update_calendar_content(
+        session, other_calendar, new_file, utils.read_calendar(new_file).events
+    )
+    session.commit()
+
+    assert session.get(CalendarFile, utils.content_hash(old_file)) is None
+    assert session.get(CalendarFile, utils.content_hash(new_file)) is not None
+
+
+def test_storing_stored_file_again(session: Session):
+    file = calendar_file([])
+    session.add(CalendarFile(content_hash=utils.content_hash(file), size=0, data=b""))
+    session.commit()
+    session.expunge_all()
+
+    # Like a concurrent upload of the same file, which stored it after this one started
+    assert store_calendar_file(session, file) == utils.content_hash(file)
+    session.commit()
+
+    assert len(session.exec(select(CalendarFile)).all()) == 1
+
+
+def test_upload_big_calendar_in_bulk(
+    client: TestClient,
+    auth_headers: dict,
+    session: Session,
+    monkeypatch,
+    big_calendar,
+    started_parse_pool,
+):
+    file = big_calendar(5_000)
+    backend = DeferredJobBackend()
+    monkeypatch.setattr(recalculation.recalculation_queue, "backend", backend)
+
+    statements, response = executed_statements(
+        session,
+        lambda: client.post(
+            "/import-calendar",
+            headers=auth_headers,
+            files={"file": ("big.ics", file)},
+        ),
+    )
+    assert len(response.json()["events"]) == 5_000
+    # File, calendar and events are written with one statement each, not one per row
+    assert statements.count("INSERT") <= 3
+
+    # Recalculation after the response replaces cleaning dates with one statement
+    recalculation_statements = []
+    event.listen(
+        session.get_bind(),
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: recalculation_statements.append(
+            statement.split()[0]
+        ),
+    )
+    backend.run_jobs()
+    assert len(session.exec(select(CleaningDate)).all()) == 4_999
+    assert recalculation_statements.count("INSERT") == 1
+    assert recalculation_statements.count("DELETE") == 1
+
+
 def test_import_from_url_invalid_url(client: TestClient, auth_headers: dict):
     response = client.post(
         "/import-from-url", headers=auth_headers, json={"url": "blabla"}
@@ -248,3 +1179,756 @@ def test_import_from_url_valid(client: TestClient, auth_headers: dict):
             "date_end": "2014-01-02",
         }
     ]
+
+
+def test_import_from_url_local_feed(
+    client: TestClient, auth_headers: dict, feed_url: str
+):
+    calendar_url = f"{feed_url}/valid/apartment_1.ics"
+
+    response = client.post(
+        "/import-from-url",
+        headers=auth_headers,
+        json={"url": calendar_url},
+    )
+
+    data = response.json()
+    assert response.status_code == status.HTTP_200_OK
+    assert data["name"] == "primjer zadatka - apartment 1"
+    assert data["url"] == calendar_url
+    assert [event["uid"] for event in data["events"]] == [
+        "aca171cfaa8cf1c5765e64e819906485",
+        "26db1820702b397cc969489412b44f6a",
+    ]
+
+
+def test_import_from_url_upsert(client: TestClient, auth_headers: dict, feed_url: str):
+    calendar_url = f"{feed_url}/valid/apartment_1.ics"
+
+    ids = []
+    for _ in range(2):
+        response = client.post(
+            "/import-from-url",
+            headers=auth_headers,
+            params={"upsert": True},
+            json={"url": calendar_url},
+        )
+        assert response.status_code == status.HTTP_200_OK
+        ids.append(response.json()["id"])
+
+    assert ids[0] == ids[1]
+    assert len(client.get("/calendars/", headers=auth_headers).json()) == 1
+
+
+def test_import_from_url_not_found(
+    client: TestClient, auth_headers: dict, feed_url: str
+):
+    response = client.post(
+        "/import-from-url",
+        headers=auth_headers,
+        json={"url": f"{feed_url}/valid/missing.ics"},
+    )
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_import_from_url_too_big(
+    client: TestClient, auth_headers: dict, feed_url: str, monkeypatch
+):
+    monkeypatch.setattr(settings, "CALENDAR_FETCH_MAX_BYTES", 100)
+
+    response = client.post(
+        "/import-from-url",
+        headers=auth_headers,
+        json={"url": f"{feed_url}/valid/apartment_1.ics"},
+    )
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert "bigger than 100 bytes" in response.json()["detail"]
+
+
+def test_import_from_url_timeout(
+    client: TestClient, auth_headers: dict, feed_url: str, monkeypatch
+):
+    monkeypatch.setattr(settings, "CALENDAR_FETCH_TIMEOUT_SECONDS", 0.1)
+
+    response = client.post(
+        "/import-from-url",
+        headers=auth_headers,
+        json={"url": f"{feed_url}/slow/valid/apartment_1.ics"},
+    )
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.anyio
+async def test_import_from_url_does_not_block_other_requests(
+    client: TestClient, auth_headers: dict, feed_url: str
+):
+    finished = []
+
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://test"
+    ) as async_client:
+
+        async def import_slow_feed():
+            response = await async_client.post(
+                "/import-from-url/",
+                headers=auth_headers,
+                json={"url": f"{feed_url}/slow/valid/apartment_1.ics"},
+            )
+            assert response.status_code == status.HTTP_200_OK
+            finished.append("import")
+
+        async def get_calendars():
+            await anyio.sleep(0.1)
+            response = await async_client.get("/calendars/", headers=auth_headers)
+            assert response.status_code == status.HTTP_200_OK
+            finished.append("get")
+
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(import_slow_feed)
+            task_group.start_soon(get_calendars)
+
+    assert finished == ["get", "import"]
+
+
+@pytest.fixture(name="file_engine")
+def file_engine_fixture(tmp_path):
+    """
+    Database in a file with its own connections, for tests that need a session per
+    request like in production
+    """
+    engine = create_db_engine(f"sqlite:///{tmp_path}/database.db")
+    SQLModel.metadata.create_all(engine)
+
+    with Session(engine) as session:
+        session.add(User(username="test_user", hashed_password=""))
+        session.commit()
+
+    yield engine
+
+    deps.authenticated_users.clear()
+
+
+def file_session_override(engine: Engine):
+    def get_session_override():
+        with Session(engine) as session:
+            yield session
+
+    return get_session_override
+
+
+def file_auth_headers() -> dict:
+    access_token = create_access_token(
+        data={"sub": "test_user"}, expires_delta=datetime.timedelta(10)
+    )
+    return {"Authorization": f"Bearer {access_token}"}
+
+
+def simulate_network_latency(engine: Engine):
+    # Round trip to a database server, the local file answers right away
+    @event.listens_for(engine, "before_cursor_execute")
+    def network_latency(*args):
+        time.sleep(0.005)
+
+
+async def measure_concurrent_requests(asgi_app, headers: dict, request_count: int):
+    """
+    Time `request_count` concurrent GET /calendars/ requests
+    """
+
+    async def get_calendars():
+        response = await async_client.get("/calendars/", headers=headers)
+        assert response.status_code == status.HTTP_200_OK
+
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=asgi_app), base_url="http://test"
+    ) as async_client:
+        start = time.perf_counter()
+        async with anyio.create_task_group() as task_group:
+            for _ in range(request_count):
+                task_group.start_soon(get_calendars)
+
+        return time.perf_counter() - start
+
+
+@pytest.mark.benchmark
+@pytest.mark.anyio
+async def test_concurrent_requests_throughput(file_engine: Engine):
+    get_session_override = file_session_override(file_engine)
+    headers = file_auth_headers()
+
+    # Same route, but as the coroutine it used to be
+    async def get_calendars_blocking(session: SessionDep, current_user: CurrentUser):
+        return calendars.load_calendars(
+            session, current_user.username, None, None, True, True
+        )
+
+    blocking_app = FastAPI()
+    blocking_app.add_api_route(
+        "/calendars/", get_calendars_blocking, response_model=list[CalendarPublic]
+    )
+
+    for asgi_app in (app, blocking_app):
+        asgi_app.dependency_overrides[get_session] = get_session_override
+
+    try:
+        upload_test_calendars(
+            TestClient(app), headers, ["apartment_1", "apartment_2", "apartment_3"]
+        )
+
+        # Round trip to a database server, the local file answers right away
+        simulate_network_latency(file_engine)
+
+        blocking_elapsed = await measure_concurrent_requests(blocking_app, headers, 200)
+        elapsed = await measure_concurrent_requests(app, headers, 200)
+    finally:
+        app.dependency_overrides.clear()
+
+    assert elapsed < blocking_elapsed / 2
+
+
+def test_authenticated_user_is_cached(file_engine: Engine):
+    app.dependency_overrides[get_session] = file_session_override(file_engine)
+    client = TestClient(app)
+    headers = file_auth_headers()
+    statements = []
+
+    @event.listens_for(file_engine, "before_cursor_execute")
+    def record_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    def get_calendars():
+        response = client.get("/calendars/", headers=headers)
+        assert response.status_code == status.HTTP_200_OK
+
+    try:
+        upload_test_calendars(client, headers, ["apartment_1", "apartment_2"])
+
+        deps.authenticated_users.clear()
+        statements.clear()
+        get_calendars()
+        first_statements = len(statements)
+
+        statements.clear()
+        get_calendars()
+        assert len(statements) == first_statements - 1
+        assert not any("FROM user" in statement for statement in statements)
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_authenticated_user_cache_invalidated(
+    client: TestClient, auth_headers: dict, session: Session
+):
+    response = client.get("/calendars/", headers=auth_headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert len(deps.authenticated_users) == 1
+
+    user = session.exec(select(User).where(User.username == "test_user")).one()
+    user.hashed_password = get_password_hash("new_password")
+    session.add(user)
+    session.commit()
+
+    assert len(deps.authenticated_users) == 0
+
+
+def test_only_big_files_parsed_in_another_process(
+    big_calendar, started_parse_pool, monkeypatch
+):
+    pool = parse_pool.get_parse_pool()
+    submitted = []
+
+    def submit(function, *args):
+        submitted.append(function)
+        return real_submit(function, *args)
+
+    real_submit = pool.submit
+    monkeypatch.setattr(pool, "submit", submit)
+
+    with open(f"{TEST_FILES_PATH}/valid/apartment_1.ics", "rb") as f:
+        parse_pool.read_calendar(f.read())
+    assert submitted == []
+
+    big_file = big_calendar(20_000)
+    assert len(big_file) >= settings.CALENDAR_PARSE_PROCESS_MIN_BYTES
+    assert len(parse_pool.read_calendar(big_file).events) == 20_000
+    assert submitted == [parse_pool.read_calendar_in_worker]
+
+
+def test_invalid_big_file_doesnt_break_parse_pool(big_calendar, started_parse_pool):
+    big_file = big_calendar(20_000)
+    invalid_file = big_file.replace(b"PRODID: big export\r\n", b"")
+    assert len(invalid_file) >= settings.CALENDAR_PARSE_PROCESS_MIN_BYTES
+
+    with pytest.raises(HTTPException) as exc_info:
+        parse_pool.read_calendar(invalid_file)
+    assert exc_info.value.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert exc_info.value.detail == "Calendar must have PRODID field"
+
+    assert len(parse_pool.read_calendar(big_file).events) == 20_000
+
+
+def test_broken_parse_pool_replaced(big_calendar, started_parse_pool, monkeypatch):
+    pool = parse_pool.get_parse_pool()
+
+    def submit(function, *args):
+        raise BrokenProcessPool("worker died")
+
+    monkeypatch.setattr(pool, "submit", submit)
+
+    with pytest.raises(BrokenProcessPool):
+        parse_pool.read_calendar(big_calendar(20_000))
+
+    assert parse_pool.get_parse_pool() is not pool
+    assert len(parse_pool.read_calendar(big_calendar(20_000)).events) == 20_000
+
+
+@pytest.mark.benchmark
+@pytest.mark.anyio
+async def test_big_uploads_dont_slow_down_other_requests(
+    client: TestClient, auth_headers: dict, big_calendar, started_parse_pool
+):
+    calendar_id, file = upload_apartment_1(client, auth_headers)
+    big_file = big_calendar(20_000)
+
+    async def small_requests_done(read_calendar) -> int:
+        """
+        Small requests answered while `read_calendar` parses the big file
+        """
+        done = 0
+        parsing = True
+
+        async def parse():
+            nonlocal parsing
+            parsed_calendar = await anyio.to_thread.run_sync(read_calendar, big_file)
+            assert len(parsed_calendar.events) == 20_000
+            parsing = False
+
+        async def small_requests():
+            nonlocal done
+            headers = {**auth_headers, "If-None-Match": f'"{utils.content_hash(file)}"'}
+            while parsing:
+                response = await async_client.get(
+                    f"/calendars/{calendar_id}/", headers=headers
+                )
+                assert response.status_code == status.HTTP_304_NOT_MODIFIED
+                done += 1
+
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        ) as async_client:
+            async with anyio.create_task_group() as task_group:
+                task_group.start_soon(parse)
+                task_group.start_soon(small_requests)
+
+        return done
+
+    in_thread = await small_requests_done(utils.read_calendar)
+    in_process = await small_requests_done(parse_pool.read_calendar)
+    assert in_process > 2 * in_thread
+
+
+def test_import_from_url_recalculates_cleaning_dates(
+    client: TestClient, auth_headers: dict, feed_url: str
+):
+    response = client.post(
+        "/import-from-url",
+        headers=auth_headers,
+        json={"url": f"{feed_url}/valid/apartment_1.ics"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+
+    job_id = response.headers["X-Recalculation-Job"]
+    response = client.get(f"/recalculation-jobs/{job_id}/", headers=auth_headers)
+    assert response.json()["status"] == "done"
+
+    calendar_data = client.get("/calendars/", headers=auth_headers).json()[0]
+    assert calendar_data["cleaning_dates"] == [{"date": "2020-10-04"}]
+
+
+def test_recalculation_job_of_other_user(
+    client: TestClient, auth_headers: dict, session: Session
+):
+    with open(f"{TEST_FILES_PATH}/valid/apartment_1.ics", "rb") as f:
+        response = client.post(
+            "/import-calendar", headers=auth_headers, files={"file": f}
+        )
+    job_id = response.headers["X-Recalculation-Job"]
+
+    session.add(User(username="other_user", hashed_password=""))
+    session.commit()
+    access_token = create_access_token(
+        data={"sub": "other_user"}, expires_delta=datetime.timedelta(10)
+    )
+    response = client.get(
+        f"/recalculation-jobs/{job_id}/",
+        headers={"Authorization": f"Bearer {access_token}"},
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_recalculation_job_header_exposed_to_frontend(
+    client: TestClient, auth_headers: dict
+):
+    with open(f"{TEST_FILES_PATH}/valid/apartment_1.ics", "rb") as f:
+        response = client.post(
+            "/import-calendar/",
+            headers={**auth_headers, "Origin": "http://localhost:3000"},
+            files={"file": f},
+        )
+
+    exposed = response.headers["Access-Control-Expose-Headers"].split(",")
+    assert "X-Recalculation-Job" in [header.strip() for header in exposed]
+
+
+def test_burst_of_imports_recalculated_once(file_engine: Engine, monkeypatch):
+    queue = recalculation.recalculation_queue
+    backend = recalculation.ThreadJobBackend()
+    monkeypatch.setattr(queue, "backend", backend)
+    # Leaves enough time for the whole burst, however slow the machine is
+    monkeypatch.setattr(queue, "max_delay_seconds", 120)
+
+    recalculations = []
+
+    def counted_recalculation(session, user, changed_calendars=None):
+        recalculations.append(changed_calendars)
+        recalculate_cleaning_dates(session, user, changed_calendars)
+
+    monkeypatch.setattr(
+        recalculation, "recalculate_cleaning_dates", counted_recalculation
+    )
+    app.dependency_overrides[get_session] = file_session_override(file_engine)
+    client = TestClient(app)
+    headers = file_auth_headers()
+
+    try:
+        job_ids = set()
+        for i in range(200):
+            day = datetime.date(2025, 1, 1) + datetime.timedelta(days=i)
+            file = calendar_file([(f"{i}", "Guest", day, day + datetime.timedelta(2))])
+            response = client.post(
+                "/import-calendar/",
+                headers=headers,
+                files={"file": (f"{i}.ics", file)},
+            )
+            assert response.status_code == status.HTTP_200_OK
+            job_ids.add(response.headers["X-Recalculation-Job"])
+
+        # Every import joined the same job, which didn't start before the burst ended
+        assert len(job_ids) == 1
+        job_id = job_ids.pop()
+        job = queue.get_job(job_id)
+        assert job is not None and job.status == "queued"
+
+        deadline = time.monotonic() + 30
+        while (
+            status_data := client.get(
+                f"/recalculation-jobs/{job_id}/", headers=headers
+            ).json()
+        )["status"] in ("queued", "running"):
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        backend.shutdown()
+        app.dependency_overrides.clear()
+
+    assert status_data["status"] == "done"
+    assert status_data["finished_at"] is not None
+    assert len(recalculations) == 1
+    assert len(recalculations[0]) == 200
+
+    with Session(file_engine) as session:
+        cleaning_dates = sorted(
+            session.exec(
+                select(col(CleaningDate.calendar_id), col(CleaningDate.date))
+            ).all()
+        )
+        user_calendars = session.exec(select(Calendar)).all()
+        assert cleaning_dates == sorted(
+            cleaning_algorithm.calculate_cleaning_dates(user_calendars)
+        )
+
+
+def test_import_calendars_batch(
+    client: TestClient, auth_headers: dict, session: Session, feed_url: str, monkeypatch
+):
+    recalculations = []
+
+    def counted_recalculation(session, user, changed_calendars=None):
+        recalculations.append(changed_calendars)
+        recalculate_cleaning_dates(session, user, changed_calendars)
+
+    monkeypatch.setattr(
+        recalculation, "recalculate_cleaning_dates", counted_recalculation
+    )
+    files = []
+    for name in [
+        "valid/apartment_1.ics",
+        "invalid/no_begin.ics",
+        "invalid/events_conflict.ics",
+    ]:
+        with open(f"{TEST_FILES_PATH}/{name}", "rb") as f:
+            files.append(("files", (name, f.read())))
+    urls = [
+        f"{feed_url}/valid/apartment_2.ics",
+        f"{feed_url}/valid/missing.ics",
+        "blabla",
+    ]
+
+    response = client.post(
+        "/import-calendars/", headers=auth_headers, files=files, data={"urls": urls}
+    )
+    assert response.status_code == status.HTTP_200_OK
+
+    results = response.json()
+    assert [result["source"] for result in results] == [
+        "valid/apartment_1.ics",
+        "invalid/no_begin.ics",
+        "invalid/events_conflict.ics",
+        *urls,
+    ]
+    assert [result["error"] is None for result in results] == [
+        True,
+        False,
+        False,
+        True,
+        False,
+        False,
+    ]
+    assert results[2]["error"]["message"] == "Events not valid"
+    assert results[3]["calendar"]["url"] == urls[0]
+
+    # Cleaning dates of the imported calendars were calculated together
+    assert len(recalculations) == 1
+    assert len(recalculations[0]) == 2
+    calendars_data = client.get("/calendars/", headers=auth_headers).json()
+    assert len(calendars_data) == 2
+    assert all(calendar["cleaning_dates"] for calendar in calendars_data)
+
+
+def test_import_calendars_batch_malformed_file(
+    client: TestClient, auth_headers: dict, monkeypatch
+):
+    read_calendar = parse_pool.read_calendar
+
+    def read_calendar_or_fail(file):
+        if file == b"crash":
+            raise BrokenProcessPool("worker died")
+        return read_calendar(file)
+
+    monkeypatch.setattr(parse_pool, "read_calendar", read_calendar_or_fail)
+    files = [("files", ("crash.ics", b"crash"))]
+    for name in ["invalid/malformed.ics", "invalid/impossible_date.ics"]:
+        with open(f"{TEST_FILES_PATH}/{name}", "rb") as f:
+            files.append(("files", (name, f.read())))
+    with open(f"{TEST_FILES_PATH}/valid/apartment_1.ics", "rb") as f:
+        files.append(("files", ("apartment_1.ics", f.read())))
+
+    response = client.post("/import-calendars/", headers=auth_headers, files=files)
+    assert response.status_code == status.HTTP_200_OK
+
+    results = response.json()
+    assert results[0]["error"] == "Calendar could not be read"
+    assert [result["calendar"] is None for result in results] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+    assert len(client.get("/calendars/", headers=auth_headers).json()) == 1
+
+
+def test_import_calendars_batch_fetches_concurrently(
+    client: TestClient, auth_headers: dict, feed_url: str, monkeypatch
+):
+    urls = [f"{feed_url}/valid/apartment_{i}.ics" for i in range(1, 5)]
+    fetch_calendar = utils.fetch_calendar
+    started = []
+
+    async def fetch_when_all_started(*args, **kwargs):
+        started.append(args[1])
+        # Fetching one URL after another would never get past this
+        with anyio.fail_after(10):
+            while len(started) < len(urls):
+                await anyio.sleep(0.01)
+        return await fetch_calendar(*args, **kwargs)
+
+    monkeypatch.setattr(utils, "fetch_calendar", fetch_when_all_started)
+
+    response = client.post(
+        "/import-calendars/", headers=auth_headers, data={"urls": urls}
+    )
+
+    assert [result["error"] for result in response.json()] == [None] * 4
+
+
+def test_import_calendars_batch_repeated_items(
+    client: TestClient, auth_headers: dict, feed_url: str
+):
+    with open(f"{TEST_FILES_PATH}/valid/apartment_1.ics", "rb") as f:
+        content = f.read()
+    files = [("files", ("first.ics", content)), ("files", ("second.ics", content))]
+    url = f"{feed_url}/valid/apartment_2.ics"
+
+    response = client.post(
+        "/import-calendars/",
+        headers=auth_headers,
+        files=files,
+        data={"urls": [url, url]},
+    )
+    assert response.status_code == status.HTTP_200_OK
+
+    results = response.json()
+    assert [result["source"] for result in results] == [
+        "first.ics",
+        "second.ics",
+        url,
+        url,
+    ]
+    ids = [result["calendar"]["id"] for result in results]
+    assert ids[0] == ids[1]
+    assert ids[2] == ids[3]
+    assert len(client.get("/calendars/", headers=auth_headers).json()) == 2
+
+
+def test_import_calendars_batch_upsert(
+    client: TestClient, auth_headers: dict, feed_url: str
+):
+    with open(f"{TEST_FILES_PATH}/valid/apartment_1.ics", "rb") as f:
+        files = [("files", ("apartment_1.ics", f.read()))]
+    urls = [f"{feed_url}/valid/apartment_2.ics"]
+
+    ids = []
+    for _ in range(2):
+        response = client.post(
+            "/import-calendars/",
+            headers=auth_headers,
+            params={"upsert": True},
+            files=files,
+            data={"urls": urls},
+        )
+        assert response.status_code == status.HTTP_200_OK
+        ids.append([result["calendar"]["id"] for result in response.json()])
+
+    assert ids[0] == ids[1]
+    assert len(client.get("/calendars/", headers=auth_headers).json()) == 2
+
+
+def test_import_calendars_batch_empty(client: TestClient, auth_headers: dict):
+    response = client.post("/import-calendars/", headers=auth_headers)
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_get_cleaning_dates(client: TestClient, auth_headers: dict):
+    upload_test_calendars(
+        client, auth_headers, ["apartment_1", "apartment_3", "apartment_4"]
+    )
+    calendars_data = client.get("/calendars/", headers=auth_headers).json()
+
+    response = client.get(
+        "/cleaning-dates/",
+        headers=auth_headers,
+        params={"from_date": "2000-01-01", "to_date": "2100-01-01"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+
+    days = response.json()
+    assert [day["date"] for day in days] == sorted({day["date"] for day in days})
+    assert sorted(
+        (day["date"], calendar["id"]) for day in days for calendar in day["calendars"]
+    ) == sorted(
+        (cleaning_date["date"], calendar["id"])
+        for calendar in calendars_data
+        for cleaning_date in calendar["cleaning_dates"]
+    )
+
+    first_day = days[0]["date"]
+    response = client.get(
+        "/cleaning-dates/",
+        headers=auth_headers,
+        params={"from_date": first_day, "to_date": first_day},
+    )
+    assert response.json() == days[:1]
+
+    response = client.get(
+        "/cleaning-dates/",
+        headers=auth_headers,
+        params={"from_date": "2024-11-09", "to_date": "2024-11-04"},
+    )
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def add_many_cleaning_dates(session: Session):
+    """
+    100 calendars of the test user with 1000 cleaning dates each, every third day
+    """
+    start = datetime.date(2020, 1, 1)
+    user_id = "test_user"
+    session.execute(
+        insert(Calendar),
+        params=[
+            {"id": calendar_id, "name": f"Apartment {calendar_id}", "user_id": user_id}
+            for calendar_id in range(1, 101)
+        ],
+    )
+    session.execute(
+        insert(CleaningDate),
+        params=[
+            {
+                "calendar_id": calendar_id,
+                "date": start + datetime.timedelta(days=3 * i + calendar_id % 3),
+            }
+            for calendar_id in range(1, 101)
+            for i in range(1000)
+        ],
+    )
+    session.commit()
+
+
+def test_cleaning_dates_use_index(auth_headers: dict, session: Session):
+    add_many_cleaning_dates(session)
+    from_date, to_date = datetime.date(2022, 3, 1), datetime.date(2022, 3, 31)
+    queries = []
+
+    def record_query(conn, cursor, statement, parameters, context, executemany):
+        queries.append((statement, parameters))
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", record_query)
+    days = calendars.load_cleaning_days(session, "test_user", from_date, to_date)
+    event.remove(engine, "before_cursor_execute", record_query)
+
+    # Every day of March has cleanings, of a third of the calendars
+    assert [day["date"] for day in days] == [
+        from_date + datetime.timedelta(days=i) for i in range(31)
+    ]
+    assert all(len(day["calendars"]) in (33, 34) for day in days)
+
+    # Through the index of cleaning dates, not scanning all 100k of them
+    statement, parameters = queries[-1]
+    plan = " ".join(
+        row[-1]
+        for row in session.connection().exec_driver_sql(
+            f"EXPLAIN QUERY PLAN {statement}", parameters
+        )
+    )
+    assert "ix_cleaningdate_calendar_id_date" in plan, plan
+    assert "SCAN cleaningdate" not in plan, plan
+
+
+@pytest.mark.benchmark
+def test_cleaning_dates_latency(auth_headers: dict, session: Session):
+    add_many_cleaning_dates(session)
+    from_date, to_date = datetime.date(2022, 3, 1), datetime.date(2022, 3, 31)
+
+    latencies = []
+    for _ in range(20):
+        started = time.perf_counter()
+        calendars.load_cleaning_days(session, "test_user", from_date, to_date)
+        latencies.append(time.perf_counter() - started)
+
+    # Median of a month of cleaning dates out of 100k
+    assert sorted(latencies)[len(latencies) // 2] < 0.01
@@ -0,0 +1,67 @@
+from sqlmodel import SQLModel, create_engine
+
+from app.recalculation import RecalculationQueue
+
+
+class ManualJobBackend:
+    delays_jobs = True
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, function, delay_seconds: float):
+        self.jobs.append(function)
+
+    def shutdown(self):
+        self.jobs.clear()
+
+
+def test_requests_merged_until_job_starts():
+    engine = create_engine("sqlite://")
+    backend = ManualJobBackend()
+    queue = RecalculationQueue(backend, delay_seconds=1, max_delay_seconds=10)
+
+    job = queue.enqueue(engine, "user", [1])
+    assert queue.enqueue(engine, "user", [2]) is job
+    assert job.changed_calendar_ids == {1, 2}
+    assert queue.enqueue(engine, "other_user", [3]) is not job
+
+    # Without calendar ids the whole schedule is recalculated
+    assert queue.enqueue(engine, "user") is job
+    assert job.changed_calendar_ids is None
+    assert queue.enqueue(engine, "user", [4]) is job
+    assert job.changed_calendar_ids is None
+    assert len(backend.jobs) == 2
+
+
+def test_merged_requests_delay_job_up_to_max_delay():
+    engine = create_engine("sqlite://")
+    queue = RecalculationQueue(ManualJobBackend(), delay_seconds=1, max_delay_seconds=2)
+
+    job = queue.enqueue(engine, "user", [1])
+    first_run_at = job.run_at
+    queue.enqueue(engine, "user", [2])
+    assert job.run_at >= first_run_at
+
+    job.latest_run_at = job.run_at
+    queue.enqueue(engine, "user", [3])
+    assert job.run_at == job.latest_run_at
+
+
+def test_shutdown_runs_queued_jobs():
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+    backend = ManualJobBackend()
+    queue = RecalculationQueue(backend, delay_seconds=1, max_delay_seconds=10)
+
+    job = queue.enqueue(engine, "user", [1])
+    start_job = backend.jobs[0]
+    queue.shutdown()
+    assert job.status == "done"
+    assert job.finished_at is not None
+
+    # Job handed over before the shutdown doesn't run again
+    finished_at = job.finished_at
+    start_job()
+    assert job.finished_at == finished_at
+    assert queue.enqueue(engine, "user", [1]) is not job
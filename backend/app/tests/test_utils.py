@@ -0,0 +1,269 @@
+import datetime
+import time
+import tracemalloc
+
+import anyio
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from app import utils
+from app.config import settings
+
+TEST_FILES_PATH = "app/tests/test_files"
+
+
+def parsed_events(calendar):
+    return [
+        (event.uid, event.summary, event.date_start, event.date_end)
+        for event in calendar.events
+    ]
+
+
+@pytest.mark.parametrize(
+    "file_name", ["apartment_1", "apartment_2", "apartment_3", "apartment_4"]
+)
+def test_streaming_matches_icalendar(file_name):
+    with open(f"{TEST_FILES_PATH}/valid/{file_name}.ics", "rb") as f:
+        file = f.read()
+
+    streamed = utils.read_calendar_streaming(file)
+    parsed = utils.read_calendar_icalendar(file)
+
+    assert streamed.name == parsed.name
+    assert parsed_events(streamed) == parsed_events(parsed)
+
+
+def test_streaming_unfolds_lines():
+    file = (
+        b"BEGIN:VCALENDAR\r\n"
+        b"PRODID:folded\r\n"
+        b"  calendar\r\n"
+        b"BEGIN:VEVENT\r\n"
+        b"DTSTART;VALUE=DATE:20241001\r\n"
+        b"DTEND;VALUE=DATE:2024\r\n"
+        b" 1003\r\n"
+        b"UID:abc\r\n"
+        b"SUMMARY:Ivica\r\n"
+        b"\t i Marica\r\n"
+        b"BEGIN:VALARM\r\n"
+        b"SUMMARY:Alarm\r\n"
+        b"END:VALARM\r\n"
+        b"END:VEVENT\r\n"
+        b"END:VCALENDAR\r\n"
+    )
+
+    calendar = utils.read_calendar_streaming(file)
+
+    assert calendar.name == "folded calendar"
+    assert parsed_events(calendar) == [
+        (
+            "abc",
+            "Ivica i Marica",
+            datetime.date(2024, 10, 1),
+            datetime.date(2024, 10, 3),
+        )
+    ]
+    assert parsed_events(calendar) == parsed_events(utils.read_calendar_icalendar(file))
+
+
+def test_falls_back_to_icalendar():
+    file = (
+        b"BEGIN:VCALENDAR\r\n"
+        b"PRODID:date-times\r\n"
+        b"BEGIN:VEVENT\r\n"
+        b"DTSTART:20241001T140000Z\r\n"
+        b"DTEND:20241003T100000Z\r\n"
+        b"UID:abc\r\n"
+        b"SUMMARY:Ivica\\, Marica\r\n"
+        b"END:VEVENT\r\n"
+        b"END:VCALENDAR\r\n"
+    )
+
+    with pytest.raises(utils.UnsupportedCalendarFormat):
+        utils.read_calendar_streaming(file)
+
+    calendar = utils.parse_calendar(file)
+    assert [event.summary for event in calendar.events] == ["Ivica, Marica"]
+    assert calendar.events[0].date_start == datetime.datetime(
+        2024, 10, 1, 14, tzinfo=datetime.timezone.utc
+    )
+
+
+@pytest.mark.parametrize(
+    "file_name",
+    ["events_conflict", "events_same_start", "no_prodid", "no_summary"],
+)
+def test_streaming_rejects_invalid(file_name, monkeypatch):
+    with open(f"{TEST_FILES_PATH}/invalid/{file_name}.ics", "rb") as f:
+        file = f.read()
+
+    # Errors have to come from the streaming parser itself
+    monkeypatch.setattr(utils, "read_calendar_icalendar", None)
+    with pytest.raises(HTTPException):
+        utils.read_calendar(file)
+
+
+def test_streaming_leaves_impossible_dates_to_icalendar():
+    with open(f"{TEST_FILES_PATH}/invalid/impossible_date.ics", "rb") as f:
+        file = f.read()
+
+    with pytest.raises(utils.UnsupportedCalendarFormat):
+        utils.read_calendar_streaming(file)
+
+    with pytest.raises(HTTPException) as exc_info:
+        utils.read_calendar(file)
+    assert exc_info.value.status_code == 422
+
+
+def peak_memory(read_calendar, file):
+    tracemalloc.start()
+    try:
+        parsed_calendar = read_calendar(file)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return parsed_calendar, peak
+
+
+def test_streaming_smaller_on_big_calendar(big_calendar):
+    file = big_calendar(5_000)
+
+    streamed, streamed_peak = peak_memory(utils.read_calendar_streaming, file)
+    parsed, parsed_peak = peak_memory(utils.read_calendar_icalendar, file)
+
+    assert parsed_events(streamed) == parsed_events(parsed)
+    # Peak is about the size of the result
+    assert streamed_peak * 3 < parsed_peak
+
+
+@pytest.mark.benchmark
+def test_streaming_faster_on_big_calendar(big_calendar):
+    file = big_calendar(5_000)
+
+    started = time.perf_counter()
+    utils.read_calendar_streaming(file)
+    streamed_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    utils.read_calendar_icalendar(file)
+    parsed_time = time.perf_counter() - started
+
+    # Roughly 10x faster
+    assert streamed_time * 3 < parsed_time
+
+
+def event(uid, start, end):
+    return utils.ParsedEvent(
+        uid=uid,
+        summary=uid,
+        date_start=datetime.date(2024, 10, start),
+        date_end=datetime.date(2024, 10, end),
+    )
+
+
+def test_validate_events_reports_every_error():
+    events = [
+        event("d", 20, 19),
+        event("a", 1, 5),
+        event("b", 4, 8),
+        event("c", 8, 12),
+        event("e", 25, 28),
+        event("f", 26, 28),
+    ]
+
+    errors = utils.validate_events(events)
+
+    assert [(error.reason, error.uid, error.other_uid) for error in errors] == [
+        ("Events overlap", "a", "b"),
+        ("Event must end after it starts", "d", None),
+        ("Events end on the same date", "e", "f"),
+    ]
+    assert errors[0].date_end == datetime.date(2024, 10, 5)
+    assert errors[0].other_date_start == datetime.date(2024, 10, 4)
+
+
+def test_validate_events_long_event_overlapping_many():
+    events = [
+        event("long", 1, 20),
+        event("a", 2, 4),
+        event("b", 5, 7),
+        event("c", 8, 10),
+        event("after", 21, 23),
+    ]
+
+    errors = utils.validate_events(events)
+
+    assert [(error.reason, error.uid, error.other_uid) for error in errors] == [
+        ("Events overlap", "long", "a"),
+        ("Events overlap", "long", "b"),
+        ("Events overlap", "long", "c"),
+    ]
+
+
+def test_validate_events_max_errors():
+    events = [event(str(day), day, day + 2) for day in range(1, 20)]
+
+    assert len(utils.validate_events(events)) == 18
+    assert len(utils.validate_events(events, max_errors=3)) == 3
+    assert not utils.check_events_valid(events)
+
+
+def test_validate_events_presorted():
+    events = [event("b", 10, 12), event("a", 1, 5)]
+
+    assert utils.validate_events(events) == []
+    # Trusting the order means "a" is seen as overlapping "b"
+    assert [
+        error.reason for error in utils.validate_events(events, presorted=True)
+    ] == ["Events overlap"]
+
+
+def test_iter_decompressed_in_chunks(big_calendar):
+    file = big_calendar(5_000)
+
+    chunks = list(utils.iter_decompressed(utils.compress_file(file)))
+
+    assert len(chunks) > 1
+    assert max(len(chunk) for chunk in chunks) <= utils.DECOMPRESSED_CHUNK_SIZE
+    assert b"".join(chunks) == file
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.mark.anyio
+async def test_fetch_calendar_ignores_malformed_content_length():
+    file = b"BEGIN:VCALENDAR\r\nEND:VCALENDAR\r\n"
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=file, headers={"Content-Length": "many"})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handle)) as client:
+        fetched = await utils.fetch_calendar(client, "http://feeds/1.ics")
+
+    assert fetched.content == file
+
+
+@pytest.mark.anyio
+async def test_fetch_calendar_deadline_stops_slow_download(monkeypatch):
+    monkeypatch.setattr(settings, "CALENDAR_FETCH_DEADLINE_SECONDS", 0.2)
+
+    async def slow_body():
+        # Every chunk arrives well within the per-read timeout
+        while True:
+            yield b"BEGIN:VEVENT\r\n"
+            await anyio.sleep(0.05)
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=slow_body())
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handle)) as client:
+        with pytest.raises(HTTPException) as exc_info:
+            await utils.fetch_calendar(client, "http://feeds/1.ics")
+
+    assert exc_info.value.status_code == 422
+    assert "took longer than" in exc_info.value.detail
@@ -1,28 +1,256 @@
+import datetime
+import gzip
+import hashlib
+import re
+import zlib
+from collections.abc import Iterator, Sequence
+from io import BytesIO
+from typing import NamedTuple
+
 from fastapi import HTTPException, status
+from fastapi.encoders import jsonable_encoder
+import anyio
+import httpx
 import icalendar
 
+from app.config import settings
 from app.models.calendars import Calendar, Event
 
 
-def check_events_valid(events: list[Event]) -> bool:
-    events.sort(key=lambda event: event.date_start)
+class ParsedEvent(NamedTuple):
+    uid: str
+    summary: str
+    date_start: datetime.date
+    date_end: datetime.date
+
+
+class ParsedCalendar(NamedTuple):
+    name: str
+    events: list[ParsedEvent]
+
+
+class FetchedCalendar(NamedTuple):
+    # None when the file didn't change since the conditional request validators
+    content: bytes | None
+    etag: str | None
+    last_modified: str | None
+
+
+class UnsupportedCalendarFormat(Exception):
+    """
+    Calendar uses something the streaming parser doesn't handle, icalendar parses it
+    """
+
+
+class EventError(NamedTuple):
+    reason: str
+    uid: str | None
+    date_start: datetime.date
+    date_end: datetime.date
+    other_uid: str | None = None
+    other_date_start: datetime.date | None = None
+    other_date_end: datetime.date | None = None
+
+
+def validate_events(
+    events: Sequence[Event | ParsedEvent],
+    presorted: bool = False,
+    max_errors: int | None = None,
+) -> list[EventError]:
+    """
+    Find every event that ends before it starts and the pairs of events that conflict,
+    in one pass over the events sorted by starting date. Each event is checked against
+    the one before it and the one reaching furthest so far, so one long event
+    overlapping many later ones is reported with each of them.
+
+    Pass `presorted` when events are already sorted by starting date, and `max_errors`
+    to stop after that many errors were found.
+    """
+    if not presorted:
+        events = sorted(events, key=lambda event: event.date_start)
+
+    errors: list[EventError] = []
+    previous_event = None
+    # Event with the latest end so far
+    furthest_event = None
 
     for event in events:
         if event.date_start >= event.date_end:
-            return False
+            errors.append(
+                EventError("Event must end after it starts", *event_fields(event))
+            )
 
-    for event, next_event in zip(events, events[1:]):
-        if event.date_start == next_event.date_start:
-            return False
-        if event.date_end == next_event.date_end:
-            return False
-        if event.date_end > next_event.date_start:
-            return False
+        other_events = [previous_event]
+        if furthest_event is not previous_event:
+            other_events.append(furthest_event)
 
-    return True
+        for other_event in other_events:
+            if other_event is None:
+                continue
 
+            reason = None
+            if other_event.date_start == event.date_start:
+                reason = "Events start on the same date"
+            elif other_event.date_end == event.date_end:
+                reason = "Events end on the same date"
+            elif other_event.date_end > event.date_start:
+                reason = "Events overlap"
 
-def parse_calendar(file: bytes) -> Calendar:
+            if reason:
+                errors.append(
+                    EventError(reason, *event_fields(other_event), *event_fields(event))
+                )
+
+        if max_errors is not None and len(errors) >= max_errors:
+            return errors[:max_errors]
+
+        previous_event = event
+        if furthest_event is None or event.date_end > furthest_event.date_end:
+            furthest_event = event
+
+    return errors
+
+
+def event_fields(
+    event: Event | ParsedEvent,
+) -> tuple[str | None, datetime.date, datetime.date]:
+    return event.uid, event.date_start, event.date_end
+
+
+def check_events_valid(events: Sequence[Event | ParsedEvent]) -> bool:
+    return not validate_events(events, max_errors=1)
+
+
+def iter_content_lines(file: bytes) -> Iterator[str]:
+    """
+    Unfolded content lines of an iCalendar file (RFC 5545, section 3.1), one at a time
+    """
+    current_line: bytes | None = None
+
+    for raw_line in BytesIO(file):
+        line = raw_line.rstrip(b"\r\n")
+
+        # Line starting with a space or a tab continues the previous one
+        if line[:1] in (b" ", b"\t") and current_line is not None:
+            current_line += line[1:]
+            continue
+
+        if current_line:
+            yield current_line.decode("utf-8")
+        current_line = line
+
+    if current_line:
+        yield current_line.decode("utf-8")
+
+
+MAX_REPORTED_EVENT_ERRORS = 20
+
+DATE_VALUE = re.compile(r"\d{8}")
+EVENT_FIELDS = {"SUMMARY", "DTSTART", "DTEND", "UID"}
+
+
+def parse_date_value(parameters: str, value: str) -> datetime.date:
+    if parameters not in ("", ";VALUE=DATE") or not DATE_VALUE.fullmatch(value):
+        # Date-times, time zones etc.
+        raise UnsupportedCalendarFormat(value)
+
+    try:
+        return datetime.date(int(value[:4]), int(value[4:6]), int(value[6:]))
+    except ValueError:
+        # Impossible date, icalendar reports it
+        raise UnsupportedCalendarFormat(value)
+
+
+def parse_text_value(value: str) -> str:
+    if "\\" in value:
+        # Escaped characters
+        raise UnsupportedCalendarFormat(value)
+
+    return value.strip()
+
+
+def read_calendar_streaming(file: bytes) -> ParsedCalendar:
+    """
+    Read only the fields we use, going through the file line by line.
+
+    Raises `UnsupportedCalendarFormat` for anything unusual, so that the file can be
+    read (and its errors reported) by icalendar instead.
+
+    The file itself is taken whole, it's kept for `CalendarFile` anyway, and events are
+    validated once all of them are read, since conflicts are found in sorted order.
+    """
+    try:
+        lines = iter_content_lines(file)
+
+        if next(lines, None) != "BEGIN:VCALENDAR":
+            raise UnsupportedCalendarFormat("calendar must start with BEGIN:VCALENDAR")
+
+        name: str | None = None
+        events: list[ParsedEvent] = []
+        components: list[str] = ["VCALENDAR"]
+        event_fields: dict[str, tuple[str, str]] = {}
+        events_complete = True
+
+        for line in lines:
+            if not components:
+                raise UnsupportedCalendarFormat("content after END:VCALENDAR")
+
+            name_and_parameters, separator, value = line.partition(":")
+            if not separator or '"' in name_and_parameters:
+                raise UnsupportedCalendarFormat(line)
+
+            property_name, _, parameters = name_and_parameters.partition(";")
+            property_name = property_name.upper()
+            parameters = f";{parameters.upper()}" if parameters else ""
+
+            if property_name == "BEGIN":
+                components.append(value.upper())
+                if value.upper() == "VEVENT":
+                    event_fields = {}
+            elif property_name == "END":
+                if components.pop() != value.upper():
+                    raise UnsupportedCalendarFormat(line)
+                if value.upper() == "VEVENT" and event_fields.keys() == EVENT_FIELDS:
+                    events.append(
+                        ParsedEvent(
+                            uid=parse_text_value(event_fields["UID"][1]),
+                            summary=parse_text_value(event_fields["SUMMARY"][1]),
+                            date_start=parse_date_value(*event_fields["DTSTART"]),
+                            date_end=parse_date_value(*event_fields["DTEND"]),
+                        )
+                    )
+                elif value.upper() == "VEVENT":
+                    events_complete = False
+            elif components == ["VCALENDAR"] and property_name == "PRODID":
+                name = parse_text_value(value)
+            elif (
+                components == ["VCALENDAR", "VEVENT"] and property_name in EVENT_FIELDS
+            ):
+                if property_name in event_fields:
+                    raise UnsupportedCalendarFormat(line)
+                event_fields[property_name] = (parameters, value)
+
+        if components:
+            raise UnsupportedCalendarFormat("calendar must end with END:VCALENDAR")
+    except UnicodeDecodeError as e:
+        raise UnsupportedCalendarFormat(e)
+
+    if name is None:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Calendar must have PRODID field",
+        )
+
+    if not events_complete:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Event must have: summary, start, end, uid",
+        )
+
+    return ParsedCalendar(name=name, events=events)
+
+
+def read_calendar_icalendar(file: bytes) -> ParsedCalendar:
     try:
         ical = icalendar.Calendar.from_ical(file.decode("utf-8"))
     except ValueError as e:
@@ -39,17 +267,13 @@ def parse_calendar(file: bytes) -> Calendar:
             detail="Calendar must have PRODID field",
         )
 
-    content = file
-    calendar = Calendar(name=name, content=content)
-
     try:
         events = [
-            Event(
+            ParsedEvent(
+                uid=str(event["UID"]).strip(),
                 summary=str(event["SUMMARY"]).strip(),
                 date_start=event["DTSTART"].dt,
                 date_end=event["DTEND"].dt,
-                uid=str(event["UID"]).strip(),
-                calendar=calendar,
             )
             for event in ical.walk("VEVENT")
         ]
@@ -59,10 +283,189 @@ def parse_calendar(file: bytes) -> Calendar:
             detail=f"Event must have: summary, start, end, uid",
         )
 
-    if not check_events_valid(events):
+    return ParsedCalendar(name=name, events=events)
+
+
+def read_calendar(file: bytes) -> ParsedCalendar:
+    """
+    Read uploaded calendar, using the streaming parser whenever it can handle the file
+    """
+    try:
+        parsed_calendar = read_calendar_streaming(file)
+    except UnsupportedCalendarFormat:
+        parsed_calendar = read_calendar_icalendar(file)
+
+    errors = validate_events(
+        parsed_calendar.events, max_errors=MAX_REPORTED_EVENT_ERRORS
+    )
+    if errors:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail="Events not valid",
+            detail={
+                "message": "Events not valid",
+                "errors": jsonable_encoder([error._asdict() for error in errors]),
+            },
+        )
+
+    return parsed_calendar
+
+
+def parse_calendar(file: bytes) -> Calendar:
+    parsed_calendar = read_calendar(file)
+
+    calendar = Calendar(
+        name=parsed_calendar.name,
+        content_hash=content_hash(file),
+    )
+
+    for event in parsed_calendar.events:
+        Event(
+            summary=event.summary,
+            date_start=event.date_start,
+            date_end=event.date_end,
+            uid=event.uid,
+            calendar=calendar,
         )
 
     return calendar
+
+
+class ScheduledCleaning(NamedTuple):
+    calendar_id: int
+    calendar_name: str | None
+    date: datetime.date
+
+
+def create_cleaning_schedule(cleanings: Sequence[ScheduledCleaning]) -> bytes:
+    """
+    iCalendar file with an all-day event for every cleaning
+    """
+    ical = icalendar.Calendar()
+    ical.add("PRODID", "-//kalendar ciscenja//cleaning schedule//EN")
+    ical.add("VERSION", "2.0")
+    generated_at = datetime.datetime.now(datetime.timezone.utc)
+
+    for cleaning in cleanings:
+        event = icalendar.Event()
+        # Stable, so subscribed apps update the same events
+        event.add("UID", f"cleaning-{cleaning.calendar_id}-{cleaning.date:%Y%m%d}")
+        event.add(
+            "SUMMARY", f"Cleaning: {cleaning.calendar_name or cleaning.calendar_id}"
+        )
+        event.add("DTSTART", cleaning.date)
+        event.add("DTEND", cleaning.date + datetime.timedelta(days=1))
+        event.add("DTSTAMP", generated_at)
+        ical.add_component(event)
+
+    return ical.to_ical()
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def compress_file(content: bytes) -> bytes:
+    # Without mtime the same file always compresses to the same bytes
+    return gzip.compress(content, mtime=0)
+
+
+DECOMPRESSED_CHUNK_SIZE = 64 * 1024
+
+
+def iter_decompressed(data: bytes) -> Iterator[bytes]:
+    """
+    Decompress gzip data in chunks of at most `DECOMPRESSED_CHUNK_SIZE` bytes
+    """
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+
+    while data:
+        chunk = decompressor.decompress(data, DECOMPRESSED_CHUNK_SIZE)
+        data = decompressor.unconsumed_tail
+        if chunk:
+            yield chunk
+
+    if chunk := decompressor.flush():
+        yield chunk
+
+
+def iter_decompressed_range(data: bytes, start: int, end: int) -> Iterator[bytes]:
+    """
+    Bytes `start` to `end` (inclusive) of the decompressed data, in chunks
+    """
+    offset = 0
+
+    for chunk in iter_decompressed(data):
+        chunk_end = offset + len(chunk)
+        if chunk_end > start:
+            yield chunk[max(start - offset, 0) : end + 1 - offset]
+        if chunk_end > end:
+            return
+        offset = chunk_end
+
+
+def conditional_request_headers(calendar: Calendar) -> dict[str, str]:
+    """
+    Headers asking the server of `calendar.url` to skip the file if it didn't change
+    """
+    headers = {}
+    if calendar.etag:
+        headers["If-None-Match"] = calendar.etag
+    if calendar.last_modified:
+        headers["If-Modified-Since"] = calendar.last_modified
+
+    return headers
+
+
+async def fetch_calendar(
+    http_client: httpx.AsyncClient, url: str, headers: dict[str, str] | None = None
+) -> FetchedCalendar:
+    """
+    Download calendar file, refusing files bigger than `CALENDAR_FETCH_MAX_BYTES`
+    """
+    max_bytes = settings.CALENDAR_FETCH_MAX_BYTES
+    deadline = settings.CALENDAR_FETCH_DEADLINE_SECONDS
+
+    try:
+        with anyio.fail_after(deadline):
+            async with http_client.stream("GET", url, headers=headers) as response:
+                if response.status_code == status.HTTP_304_NOT_MODIFIED:
+                    return FetchedCalendar(
+                        content=None,
+                        etag=response.headers.get("ETag"),
+                        last_modified=response.headers.get("Last-Modified"),
+                    )
+
+                response.raise_for_status()
+
+                # Malformed lengths are left to the check while downloading
+                content_length = response.headers.get("Content-Length", "")
+                if content_length.isdigit() and int(content_length) > max_bytes:
+                    raise HTTPException(
+                        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        detail=f"File on {url} is bigger than {max_bytes} bytes",
+                    )
+
+                content = bytearray()
+                async for chunk in response.aiter_bytes():
+                    content += chunk
+                    if len(content) > max_bytes:
+                        raise HTTPException(
+                            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"File on {url} is bigger than {max_bytes} bytes",
+                        )
+    except TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Downloading {url} took longer than {deadline} seconds",
+        )
+    except (httpx.HTTPError, httpx.InvalidURL) as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Cannot get file from {url}: {e}",
+        )
+
+    return FetchedCalendar(
+        content=bytes(content),
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
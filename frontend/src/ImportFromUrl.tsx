@@ -1,6 +1,7 @@
 import { Dispatch, SetStateAction, useState } from "react";
 import toast from "react-hot-toast";
 import "../index.css"
+import { waitForRecalculation } from "./api/waitForRecalculation.ts";
 
 const ImportFromURL = ({ token, setTrigger }: { token: string, setTrigger: Dispatch<SetStateAction<boolean>> }) => {
     const [url, setUrl] = useState("");
@@ -29,6 +30,8 @@ const ImportFromURL = ({ token, setTrigger }: { token: string, setTrigger: Dispa
                 throw new Error(`HTTP error! Status: ${response.status}`);
             }
 
+            // Cleaning dates shown after the refresh have to include this import
+            await waitForRecalculation(token, response);
             toast.success("URL imported successfully!");
             setTrigger(prev => !prev)
         } catch (error) {
@@ -1,6 +1,7 @@
 import { useState, Dispatch, SetStateAction } from "react";
 import toast from "react-hot-toast";
 import "../index.css"
+import { waitForRecalculation } from "./api/waitForRecalculation.ts";
 
 const UploadButton = ({ token, setTrigger }: { token: string, setTrigger: Dispatch<SetStateAction<boolean>> }) => {
     const [file, setFile] = useState(null);
@@ -31,6 +32,8 @@ const UploadButton = ({ token, setTrigger }: { token: string, setTrigger: Dispat
                 throw new Error(`Error uploading file: ${response.status}`);
             }
 
+            // Cleaning dates shown after the refresh have to include this import
+            await waitForRecalculation(token, response);
             toast.success('Successfully uploaded!')
             setTrigger(prev => !prev)
 
@@ -0,0 +1,32 @@
+// Imports respond before their cleaning dates are recalculated, the job in the
+// X-Recalculation-Job header tells when they are
+export const waitForRecalculation = async (token: string, response: Response) => {
+  const jobId = response.headers.get('X-Recalculation-Job');
+  if (!jobId) {
+    return;
+  }
+
+  try {
+    while (true) {
+      const jobResponse = await fetch(`http://127.0.0.1:3107/recalculation-jobs/${jobId}/`, {
+        method: 'GET',
+        headers: {
+          authorization: `Bearer ${token}`
+        }
+      });
+      if (!jobResponse.ok) {
+        throw new Error(`HTTP error! status: ${jobResponse.status}`);
+      }
+
+      const job = await jobResponse.json();
+      if (job.status !== 'queued' && job.status !== 'running') {
+        return job;
+      }
+      await new Promise(resolve => setTimeout(resolve, 500));
+    }
+  } catch (error) {
+    throw new Error(
+      `Caught error! Error: ${error instanceof Error ? error.message : 'Unknown error'}`
+    );
+  }
+};